@@ -1,12 +1,30 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 import argparse
+import asyncio
+import binascii
+import bisect
+import glob
+import gzip
+import io
+import itertools
+import json
+import lzma
+import mmap
+import os
+import queue
 import re
+import stat
+import struct
 import sys
+import threading
 import time
 import traceback
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from functools import wraps
-from typing import Generator, TextIO, BinaryIO
+from typing import AsyncGenerator, Callable, Generator, TextIO, BinaryIO, List, Tuple
 
 import serial
 
@@ -14,8 +32,72 @@ MAX_RETRIES = 5
 NAND_SIZE = 524288 * 1024
 BLOCK_SIZE = 128 * 1024
 PAGE_SIZE = 2048
+PROMPT_TIMEOUT = 5.0
+BAUD_SETTLE_TIME = 0.2
+WINDOW = 1
+# Pages at the start of each block carrying the factory bad block marker
+BBM_PAGES = 2
+MULTI_REFRESH_INTERVAL = 1.0
+# Input buffered by the serial reader thread, and how often it checks whether it should stop
+PIPELINE_BUFFER_SIZE = 16 * 1024 * 1024
+READER_POLL_TIMEOUT = 0.05
+# Output buffering, and how often written data is made durable
+WRITE_BUFFER_SIZE = 1024 * 1024
+CHECKPOINT_SIZE = 16 * 1024 * 1024
+CHECKPOINT_INTERVAL = 5.0
+# Offset, size and memory alignment required by O_DIRECT
+DIRECT_ALIGNMENT = 4096
+# Disk space used by the page store, beyond which the least recently used blocks are evicted
+PAGE_STORE_SIZE = 1024 * 1024 * 1024
+# Block files the page store keeps open
+STORE_HANDLES = 16
+# Raw console data is compressed and written out this much at a time
+CAPTURE_CHUNK_SIZE = 256 * 1024
+# Chunks queued for the compression thread before reading waits for it
+CAPTURE_MAX_PENDING = 8
+# Min seconds between progress updates, and over which speed is averaged
+PROGRESS_INTERVAL = 0.1
+SPEED_WINDOW = 5.0
+MMAP_CHUNK_SIZE = 1024 * 1024
+# Memory used by the page cache of a NandImage, which also caps how many pages a single dn command fetches
+NAND_CACHE_SIZE = 16 * 1024 * 1024
+# Compressed captures are decompressed this much at a time, up to DECOMPRESS_QUEUE_SIZE chunks ahead of parsing
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+DECOMPRESS_QUEUE_SIZE = 8
+# A followed capture is polled for growth every FOLLOW_POLL_MIN seconds, backing off up to FOLLOW_POLL_MAX, and
+# considered finished once it hasn't grown for FOLLOW_TIMEOUT seconds
+FOLLOW_POLL_MIN = 0.01
+FOLLOW_POLL_MAX = 0.5
+FOLLOW_TIMEOUT = 30.0
+# Approximate size of the capture slices decoded by each worker process
+PARALLEL_CHUNK_SIZE = 4 * 1024 * 1024
+
+PROMPT = b"CFE>"
+SYNC_PROMPT = 'prompt'
+SYNC_JUNK = 'junk'
+SYNC_MODES = (SYNC_PROMPT, SYNC_JUNK)
+
+# Messages CFE may print in between page data
+ERROR_LINE_PREFIXES = (
+    b"Uncorrectable ECC Error",
+    b"nand_flash_read_buf(): Att",
+    b"Error reading block",
+    # danitool: eat crashing line
+    b"Correctable ECC Error detected",
+)
+# Messages after which the data of the page being read can't be trusted
+BAD_PAGE_LINE_PREFIXES = ERROR_LINE_PREFIXES[:3]
 
 line_regex = re.compile(r'(?P<addr>[0-9a-fA-F]{8}):(?P<data>(?: [0-9a-fA-F]{8}){4})(?:\s+.{16})?')
+page_header_regex = re.compile(rb'block:\s*(?P<block>\d+),\s*page:\s*(?P<page>\d+)')
+
+# Column layout of a `dn` data line: "aaaaaaaa: dddddddd dddddddd dddddddd dddddddd    ascii"
+LINE_ADDR_END = 8
+LINE_DATA_START = 9
+LINE_DATA_END = 45
+LINE_DATA_SIZE = 16
+# Hex digits per group in the data columns, each group preceded by a space
+LINE_DATA_GROUP = 8
 
 
 def parse_hex_byte_string(hexbytes: str) -> bytes:
@@ -25,17 +107,46 @@ def parse_hex_byte_string(hexbytes: str) -> bytes:
 
 def parse_serial_line(line: str) -> (int, bytes):
     m = line_regex.match(line)
+    if m is None:
+        raise ValueError("Malformed line")
+
+    addr = int(m.group('addr'), 16)
+    bstr = b''
+    for chunk in m.group('data').split():
+        bstr += parse_hex_byte_string(chunk)
+
+    return addr, bstr
+
+
+def parse_serial_lines(lines: List[bytes]) -> Tuple[Tuple[int, ...], bytes]:
+    """
+    Decode a batch of stripped `dn` data lines in one pass.
+
+    Returns the line addresses and the concatenated data. Raises ValueError if
+    any of the lines is malformed; use parse_serial_line to find out which one.
+    Every line must have its spaces where they belong and nowhere else in
+    the data columns, so that a line with a digit too many can't make up for
+    one with a digit too few.
+    """
+    count = len(lines)
+    for line in lines:
+        if len(line) < LINE_DATA_END or line[LINE_ADDR_END] != 0x3a:  # ':'
+            raise ValueError("Malformed line: {!r}".format(line))
+
+    # The data columns of every line are 4 groups of " dddddddd"
+    columns = b''.join([line[LINE_DATA_START:LINE_DATA_END] for line in lines])
+    group = LINE_DATA_GROUP + 1
+    spaces = count * (LINE_DATA_END - LINE_DATA_START) // group
+    if columns[::group] != b' ' * spaces or columns.count(b' ') != spaces:
+        raise ValueError("Malformed data columns")
 
     try:
-        addr = int(m.group('addr'), 16)
-        bstr = b''
-        for chunk in m.group('data').split():
-            bstr += parse_hex_byte_string(chunk)
+        addrs = binascii.unhexlify(b''.join([line[:LINE_ADDR_END] for line in lines]))
+        data = binascii.unhexlify(columns.replace(b' ', b''))
+    except binascii.Error as e:
+        raise ValueError(str(e)) from e
 
-        return addr, bstr
-    except Exception:
-        print("\n\nError caused by line: '{}'".format(line))
-        raise
+    return struct.unpack(">{}I".format(count), addrs), data
 
 
 def format_size(size: int) -> str:
@@ -68,6 +179,20 @@ def format_time(time: int) -> str:
     return "{}d {}h {}m {}s".format(time, h, m, s)
 
 
+def print_offset_on_exc_func(func):
+    @wraps(func)
+    def wrapper(self, *a, **kw):
+        try:
+            return func(self, *a, **kw)
+        except Exception as e:
+            if not getattr(e, "offset_printed", None):
+                self.printer.msg("Error at offset {} in file".format(self.input_file.tell()))
+                e.offset_printed = True
+            raise e
+
+    return wrapper
+
+
 def print_offset_on_exc(gen):
     @wraps(gen)
     def wrapper(self, *a, **kw):
@@ -75,7 +200,7 @@ def print_offset_on_exc(gen):
             yield from gen(self, *a, **kw)
         except Exception as e:
             if not getattr(e, "offset_printed", None):
-                print("Error at offset {} in file".format(self.input_file.tell()))
+                self.printer.msg("Error at offset {} in file".format(self.input_file.tell()))
                 e.offset_printed = True
             raise e
 
@@ -98,10 +223,10 @@ class PrettyPrinter:
             self._lastline_len = len(lines[-1])
 
             for l in lines[:-1]:
-                print(string, file=self.out)
+                print(l, file=self.out)
 
             if lines[-1] != '':
-                print(string, file=self.out, end='')
+                print(lines[-1], file=self.out, end='')
 
         self.out.flush()
 
@@ -118,6 +243,26 @@ class PrettyPrinter:
         self.error(string)
 
 
+class SpeedMeter:
+    """
+    Moving average of the progress rate over the last `window` seconds.
+    """
+
+    def __init__(self, window: float = SPEED_WINDOW):
+        self.window = window
+        self._samples = deque()
+
+    def update(self, done: int, now: float = None) -> float:
+        if now is None:
+            now = time.monotonic()
+        self._samples.append((now, done))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.window:
+            self._samples.popleft()
+
+        first_time, first_done = self._samples[0]
+        return (done - first_done) / (now - first_time) if now > first_time else 0.0
+
+
 class ProgressPrinter(PrettyPrinter):
     chars = "⡏⠟⠻⢹⣸⣴⣦⣇"
 
@@ -126,55 +271,822 @@ class ProgressPrinter(PrettyPrinter):
         self.item_size = item_size
         self.item_name = item_name
         self._chars_step = 0
-        self._last_done = -1
         self._last_total = -1
         self._clean = True
         self._last_time = -1
+        self._speed = SpeedMeter()
 
     def clear_line(self):
         super().clear_line()
         self._clean = True
 
-    def print_progress(self, done, total):
+    def print_progress(self, done, total, force=False):
+        # Called for every item: only render every PROGRESS_INTERVAL
+        now = time.monotonic()
+        if not force and done != total and total == self._last_total and now - self._last_time < PROGRESS_INTERVAL:
+            return
+
         if self._last_total != total:
             self.clear_line()
+            self._speed = SpeedMeter()
 
         string = "\r {} ".format(self.chars[self._chars_step])
 
         string += "[{}/{} {}] ".format(done, total, self.item_name)
         string += "[{}/{}] ".format(format_size(done * self.item_size), format_size(total * self.item_size))
 
-        if self._last_time > 0:
-            delta_t = time.time() - self._last_time
-            delta_b = done - self._last_done
-            speed = delta_b / delta_t
+        speed = self._speed.update(done, now)
+        if speed:
+            string += "[{}/s] ".format(format_size(speed * self.item_size))
+            string += "[ETA: {}]".format(format_time(int((total - done) // speed)))
 
-            string += "[{}/s] ".format(format_size(speed))
+        self._chars_step = (self._chars_step + 1) % len(self.chars)
+        self._last_total = total
+        self._last_time = now
 
-            remaining = total - done
-            try:
-                eta = int(remaining // speed)
-            except ZeroDivisionError:
-                eta = int(0)
+        self.print(string)
 
-            string += "[ETA: {}]".format(format_time(eta))
 
-        self._chars_step = (self._chars_step + 1) % len(self.chars)
-        self._last_done = done
-        self._last_total = total
-        self._last_time = time.time()
+class DeviceProgress(PrettyPrinter):
+    """
+    Keeps track of the progress of one of several concurrent dumps instead of
+    printing it; the last message is kept as the dump's status.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(sys.stderr)
+        self.name = name
+        self.done = 0
+        self.total = 0
+        self.status = "starting"
+        self.finished = False
+        self.speed = SpeedMeter()
+
+    def clear_line(self):
+        pass
+
+    def print(self, string):
+        string = string.strip()
+        if string:
+            self.status = string.splitlines()[-1].strip()
 
+    def msg(self, string):
         self.print(string)
 
+    def print_progress(self, done, total, force=False):
+        self.done = done
+        self.total = total
+        self.status = "dumping"
+
+
+class MultiProgressPrinter(PrettyPrinter):
+    def __init__(self, out: TextIO, item_size: int, item_name: str):
+        super().__init__(out)
+        self.item_size = item_size
+        self.item_name = item_name
+        self._rendered = 0
+
+    def format_row(self, name: str, done: int, total: int, speed: float, status: str) -> str:
+        string = "{:<16} [{}/{} {}] ".format(name, done, total, self.item_name)
+        string += "[{}/{}] ".format(format_size(done * self.item_size), format_size(total * self.item_size))
+        string += "[{}/s] ".format(format_size(speed * self.item_size))
+
+        try:
+            string += "[ETA: {}] ".format(format_time(int((total - done) // speed)))
+        except ZeroDivisionError:
+            string += "[ETA: -] "
+
+        return string + status
+
+    def render(self, devices: List[DeviceProgress]) -> None:
+        now = time.monotonic()
+        rows = []
+        speeds = []
+
+        for d in devices:
+            speed = d.speed.update(d.done, now) if not d.finished else 0
+            speeds.append(speed)
+            rows.append(self.format_row(d.name, d.done, d.total, speed, d.status))
+
+        rows.append(self.format_row("total", sum(d.done for d in devices), sum(d.total for d in devices),
+                                    sum(speeds), "{}/{} finished".format(sum(d.finished for d in devices),
+                                                                         len(devices))))
+
+        # Move back to the top of the previous table and redraw it
+        if self._rendered:
+            self.out.write("\x1b[{}F".format(self._rendered))
+        for row in rows:
+            self.out.write(row + "\x1b[K\n")
+        self.out.flush()
+        self._rendered = len(rows)
+
+
+class DumpJournal:
+    """
+    Sidecar file recording which pages of an output image have been written,
+    and their CRC32, so that an interrupted dump can be resumed.
+
+    Layout: header, bitmap of completed pages, big-endian CRC32 of each page.
+    """
+    header = struct.Struct(">4sIII")
+    magic = b"CFEJ"
+
+    def __init__(self, path: str, page_size: int, first_page: int, pages: int):
+        self.path = path
+        self.page_size = page_size
+        self.first_page = first_page
+        self.pages = pages
+        self.bitmap_offset = self.header.size
+        self.crc_offset = self.bitmap_offset + (pages + 7) // 8
+
+        if os.path.exists(path):
+            self.file = open(path, 'r+b')
+            fields = self.header.unpack(self.file.read(self.header.size))
+            if fields != (self.magic, page_size, first_page, pages):
+                self.file.close()
+                raise ValueError("Journal {} was written for a different dump".format(path))
+            self.bitmap = bytearray(self.file.read(self.crc_offset - self.bitmap_offset))
+            self.crcs = bytearray(self.file.read(pages * 4))
+        else:
+            self.file = open(path, 'w+b')
+            self.bitmap = bytearray(self.crc_offset - self.bitmap_offset)
+            self.crcs = bytearray(pages * 4)
+            self.file.write(self.header.pack(self.magic, page_size, first_page, pages))
+            self.file.write(self.bitmap)
+            self.file.write(self.crcs)
+            self.file.flush()
+
+    def is_done(self, page: int) -> bool:
+        i = page - self.first_page
+        return bool(self.bitmap[i // 8] & (1 << (i % 8)))
+
+    def mark_crc(self, page: int, crc: int) -> None:
+        i = page - self.first_page
+        struct.pack_into(">I", self.crcs, i * 4, crc)
+        self.bitmap[i // 8] |= 1 << (i % 8)
+
+        # The CRC goes first, so a set bit always comes with a valid CRC
+        self.file.seek(self.crc_offset + i * 4)
+        self.file.write(self.crcs[i * 4:i * 4 + 4])
+        self.file.seek(self.bitmap_offset + i // 8)
+        self.file.write(self.bitmap[i // 8:i // 8 + 1])
+
+    def verify(self, image: BinaryIO) -> int:
+        """
+        Check the pages marked as done against the image, forgetting those
+        whose data doesn't match. Returns the number of pages dropped.
+        """
+        dropped = 0
+
+        for page in range(self.first_page, self.first_page + self.pages):
+            if not self.is_done(page):
+                continue
+
+            i = page - self.first_page
+            image.seek(i * self.page_size)
+            data = image.read(self.page_size)
+            if len(data) != self.page_size or zlib.crc32(data) != struct.unpack_from(">I", self.crcs, i * 4)[0]:
+                self.bitmap[i // 8] &= ~(1 << (i % 8))
+                self.file.seek(self.bitmap_offset + i // 8)
+                self.file.write(self.bitmap[i // 8:i // 8 + 1])
+                dropped += 1
+
+        self.file.flush()
+        return dropped
+
+    def missing_runs(self) -> Generator[Tuple[int, int], None, None]:
+        """
+        Yield (first page, count) for every run of pages not yet done.
+        """
+        start = None
+
+        for page in range(self.first_page, self.first_page + self.pages):
+            if self.is_done(page):
+                if start is not None:
+                    yield start, page - start
+                    start = None
+            elif start is None:
+                start = page
+
+        if start is not None:
+            yield start, self.first_page + self.pages - start
+
+    def checkpoint(self, marks: List[Tuple[int, int]]) -> None:
+        """
+        Durably mark pages as done, given as (page, CRC32) once their data is
+        durable itself.
+        """
+        for page, crc in marks:
+            self.mark_crc(page, crc)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class PageStore:
+    """
+    Persistent store of the pages read from boards, shared by every session
+    using the same directory, so that pages already transferred are never
+    read again.
+
+    Each board has a directory named after its identity, which has to be
+    unique to it (e.g. a serial number: boards of a kind often have identical
+    contents). Each block has a file in it per layout (pages per block, page
+    size and spare area size), so dumps with and without the spare area don't
+    replace each other's pages. File layout: header, then for every page of
+    the block its flags and big-endian CRC32, then the page records (main and
+    spare area) at fixed offsets. A page is only served if it's marked as
+    present and matches its CRC32. A block file whose header doesn't match its
+    name is left alone and reported.
+
+    Up to `STORE_HANDLES` block files are kept open. When the store is
+    closed, the least recently used block files (of all the boards) are
+    removed until it fits in `max_size` bytes.
+    """
+    header = struct.Struct(">4sIII")
+    entry = struct.Struct(">BI")
+    magic = b"CFEP"
+    PRESENT = 1
+
+    def __init__(self, path: str, board: str, page_size: int, oob_size: int, pages_per_block: int,
+                 max_size: int = PAGE_STORE_SIZE):
+        self.path = path
+        self.directory = os.path.join(path, re.sub(r'[^\w.-]', '_', board))
+        self.page_size = page_size
+        self.oob_size = oob_size
+        self.pages_per_block = pages_per_block
+        self.record_size = page_size + oob_size
+        self.max_size = max_size
+        self.fields = (self.magic, page_size, oob_size, pages_per_block)
+        self.records_offset = self.header.size + pages_per_block * self.entry.size
+        self.layout = "{}x{}+{}".format(pages_per_block, page_size, oob_size)
+        # Open block files, least recently used first, and blocks whose modification time was refreshed
+        self._files = OrderedDict()
+        self._touched = set()
+        self.hits = 0
+        self.stored = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _block_path(self, block: int) -> str:
+        return os.path.join(self.directory, "{}-{}.blk".format(block, self.layout))
+
+    def _open(self, block: int, write: bool = False):
+        """
+        The file of a block, or None if it doesn't exist. When writing, it's
+        created as needed.
+        """
+        f = self._files.get(block)
+        if f is not None:
+            self._files.move_to_end(block)
+            return f
+
+        path = self._block_path(block)
+        try:
+            f = open(path, 'r+b')
+        except FileNotFoundError:
+            if not write:
+                return None
+            f = open(path, 'w+b')
+
+        header = f.read(self.header.size)
+        # An empty file is one whose creation was interrupted
+        if not header:
+            f.write(self.header.pack(*self.fields))
+            f.write(b'\0' * (self.pages_per_block * self.entry.size))
+            f.flush()
+        elif header.ljust(self.header.size, b'\0') != self.header.pack(*self.fields):
+            f.close()
+            raise ValueError("Block file {} doesn't have the expected layout ({}), remove it to store the block "
+                             "again".format(path, self.layout))
+
+        self._files[block] = f
+        if len(self._files) > STORE_HANDLES:
+            self._files.popitem(last=False)[1].close()
+        return f
+
+    def has(self, page: int) -> bool:
+        block, page = divmod(page, self.pages_per_block)
+        f = self._open(block)
+        if f is None:
+            return False
+        f.seek(self.header.size + page * self.entry.size)
+        flags, _ = self.entry.unpack(f.read(self.entry.size))
+        return bool(flags & self.PRESENT)
+
+    def get(self, page: int) -> bytes:
+        """
+        Returns the record of a page, or None if it isn't in the store (or
+        doesn't match its CRC32).
+        """
+        block, page = divmod(page, self.pages_per_block)
+        f = self._open(block)
+        if f is None:
+            return None
+        f.seek(self.header.size + page * self.entry.size)
+        flags, crc = self.entry.unpack(f.read(self.entry.size))
+        if not flags & self.PRESENT:
+            return None
+        f.seek(self.records_offset + page * self.record_size)
+        data = f.read(self.record_size)
+
+        if len(data) != self.record_size or zlib.crc32(data) != crc:
+            return None
+
+        if block not in self._touched:
+            os.utime(self._block_path(block))
+            self._touched.add(block)
+        self.hits += 1
+        return data
+
+    def put(self, page: int, data: bytes) -> None:
+        block, page = divmod(page, self.pages_per_block)
+        f = self._open(block, write=True)
+        # The data goes first, so a page marked as present always has its data
+        f.seek(self.records_offset + page * self.record_size)
+        f.write(data)
+        f.seek(self.header.size + page * self.entry.size)
+        f.write(self.entry.pack(self.PRESENT, zlib.crc32(data)))
+        # Other sessions sharing the store see the page as soon as it's stored
+        f.flush()
+        self._touched.add(block)
+        self.stored += 1
+
+    def evict(self) -> int:
+        """
+        Remove the least recently used block files until the store fits in
+        max_size. Returns the number of files removed.
+        """
+        files = []
+        for board in os.scandir(self.path):
+            if board.is_dir():
+                files += [(f.stat().st_mtime, f.stat().st_blocks * 512, f.path) for f in os.scandir(board.path)
+                          if f.name.endswith(".blk")]
+
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+    def stats(self) -> str:
+        return "{} pages served from {}, {} stored".format(self.hits, self.directory, self.stored)
+
+    def close(self) -> None:
+        while self._files:
+            self._files.popitem()[1].close()
+        self.evict()
+
+
+class OutputWriter:
+    """
+    Buffered writer for an output file of a dump.
+
+    Data is collected in a buffer of buffer_size bytes, which is written out
+    from a background thread with positional writes while the other buffer
+    fills up, so that slow storage doesn't hold up reading. The thread can be
+    shared by several writers (and the journal), so that their writes and
+    syncs happen in the order they are submitted.
+
+    With `direct`, the file is written with O_DIRECT, bypassing the page cache;
+    the writes that aren't aligned (the last one, and after seeks) go through
+    the page cache anyway.
+    """
+
+    def __init__(self, file: BinaryIO, executor: ThreadPoolExecutor, buffer_size: int = WRITE_BUFFER_SIZE,
+                 direct: bool = False):
+        self.fd = file.fileno()
+        self.executor = executor
+        self.direct = direct
+        mode = os.fstat(self.fd).st_mode
+        self.positional = stat.S_ISREG(mode) or stat.S_ISBLK(mode)
+
+        if direct:
+            if not hasattr(os, 'O_DIRECT'):
+                raise ValueError("O_DIRECT isn't supported on this platform")
+            if buffer_size % DIRECT_ALIGNMENT:
+                raise ValueError("With O_DIRECT the write buffer size must be a multiple of {}"
+                                 .format(DIRECT_ALIGNMENT))
+
+        # Anonymous mappings are page aligned, as O_DIRECT needs
+        self._buffers = [mmap.mmap(-1, buffer_size), mmap.mmap(-1, buffer_size)]
+        self._jobs = [None, None]
+        self._sync_job = None
+        self._current = 0
+        self._used = 0
+        # Where the data in the current buffer goes
+        self.offset = file.tell()
+        # Bytes written since the last sync
+        self.pending = 0
+        # Time spent waiting for the background thread
+        self.wait_time = 0.0
+
+    def preallocate(self, size: int) -> None:
+        if self.positional and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self.fd, 0, size)
+
+    def write(self, data: bytes) -> None:
+        data = memoryview(data)
+        self.pending += len(data)
+
+        while data:
+            buf = self._buffers[self._current]
+            count = min(len(data), len(buf) - self._used)
+            buf[self._used:self._used + count] = data[:count]
+            self._used += count
+            data = data[count:]
+
+            if self._used == len(buf):
+                self._submit()
+
+    def seek(self, offset: int) -> None:
+        self._submit()
+        self.offset = offset
+
+    def tell(self) -> int:
+        return self.offset + self._used
+
+    def _submit(self) -> None:
+        if not self._used:
+            return
+
+        view = memoryview(self._buffers[self._current])[:self._used]
+        self._jobs[self._current] = self.executor.submit(self._write_out, view, self.offset)
+        self.offset += self._used
+        self._used = 0
+
+        # The other buffer must have been written out before it's reused
+        self._current ^= 1
+        if self._jobs[self._current]:
+            self._wait(self._jobs[self._current])
+            self._jobs[self._current] = None
+
+    def _wait(self, job) -> None:
+        start = time.monotonic()
+        job.result()
+        self.wait_time += time.monotonic() - start
+
+    def _write_out(self, view: memoryview, offset: int) -> None:
+        with view:
+            if self.direct:
+                self._set_direct(offset % DIRECT_ALIGNMENT == 0 and len(view) % DIRECT_ALIGNMENT == 0)
+
+            done = 0
+            while done < len(view):
+                if self.positional:
+                    done += os.pwrite(self.fd, view[done:], offset + done)
+                else:
+                    done += os.write(self.fd, view[done:])
+
+    def _set_direct(self, enabled: bool) -> None:
+        import fcntl
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_DIRECT if enabled else flags & ~os.O_DIRECT)
+
+    def _fsync(self) -> None:
+        if self.positional:
+            os.fsync(self.fd)
+
+    def sync(self) -> None:
+        """
+        Write out the buffer and make everything written so far durable, in
+        the background.
+        """
+        self._submit()
+        if self._sync_job:
+            self._wait(self._sync_job)
+        self._sync_job = self.executor.submit(self._fsync)
+        self.pending = 0
+
+    def close(self) -> None:
+        """
+        Write out and sync everything, raising any error that happened in the
+        background. The file itself is left open.
+        """
+        self.sync()
+        for job in self._jobs + [self._sync_job]:
+            if job:
+                job.result()
+        for buf in self._buffers:
+            buf.close()
+
+
+class DumpMetrics:
+    """
+    Per page timings and counters of a dump: when the command reading it was
+    sent, when the first byte of its output arrived, when its data ended and
+    when the prompt was seen, along with the bytes on the wire, the retries
+    and the error messages received since the previous page.
+
+    Pages read by the same command share its events, except for the end of
+    their data: they're held until the next command is sent (or the metrics
+    closed), so that the prompt ending their command is known.
+
+    Written as JSON lines, or as a Prometheus textfile (node_exporter
+    textfile collector format) with the totals at the end.
+    """
+    FORMATS = ('jsonl', 'prometheus')
+    EVENTS = ('sent', 'first_byte', 'data_end', 'prompt')
+    # Phases of a command (latency, prompt_wait) or of a page (transfer), between two events
+    PHASES = ('latency', 'transfer', 'prompt_wait')
+    COUNTERS = ('rx_bytes', 'tx_bytes', 'retries', 'ecc_messages')
+
+    def __init__(self, path: str, fmt: str, device: str):
+        if fmt not in self.FORMATS:
+            raise ValueError("Unknown metrics format '{}'".format(fmt))
+
+        self.path = path
+        self.format = fmt
+        self.device = device
+        self.start = time.monotonic()
+        self.last_page = self.start
+        # Events of the current command, and end of the data of the page being read
+        self.events = {}
+        self.data_end = None
+        # Pages read by the current command: page number, pages per block, duration, data end and counters
+        self.pending = []
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.totals = dict.fromkeys(self.COUNTERS, 0)
+        self.pages = 0
+        # Sum and count of the duration of each phase
+        self.phases = {name: [0.0, 0] for name in self.PHASES}
+        self.file = open(path, 'w') if fmt == 'jsonl' else None
+
+    def mark(self, event: str) -> None:
+        if event == 'data_end':
+            self.data_end = time.monotonic()
+        else:
+            self.events[event] = time.monotonic()
+
+    def sent(self, data: bytes) -> None:
+        self.counters['tx_bytes'] += len(data)
+        self.finish_command()
+        self.events = {'sent': time.monotonic()}
+
+    def received(self, data: bytes) -> None:
+        self.counters['rx_bytes'] += len(data)
+        if 'first_byte' not in self.events and 'sent' in self.events:
+            self.events['first_byte'] = time.monotonic()
+        if data.lstrip().startswith(ERROR_LINE_PREFIXES):
+            self.counters['ecc_messages'] += 1
+
+    def retry(self) -> None:
+        self.counters['retries'] += 1
+
+    def page(self, page: int, pages_per_block: int) -> None:
+        """
+        Record a page as read, with the counters since the previous one.
+        """
+        now = time.monotonic()
+        self.pending.append((page, pages_per_block, now - self.last_page, self.data_end, self.counters))
+        for counter, value in self.counters.items():
+            self.totals[counter] += value
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.data_end = None
+        self.pages += 1
+        self.last_page = now
+
+    def _phase(self, name: str, start: float, end: float) -> None:
+        if start is not None and end is not None and end >= start:
+            self.phases[name][0] += end - start
+            self.phases[name][1] += 1
+
+    def finish_command(self) -> None:
+        """
+        Write out the pages read by the current command, along with its events.
+        """
+        if not self.pending:
+            return
+
+        events = self.events
+        self._phase('latency', events.get('sent'), events.get('first_byte'))
+        self._phase('prompt_wait', self.pending[-1][3], events.get('prompt'))
+        # Each page's data follows the previous one's
+        previous = events.get('first_byte')
+
+        for page, pages_per_block, duration, data_end, counters in self.pending:
+            self._phase('transfer', previous, data_end)
+            previous = data_end
+
+            if self.file:
+                record = {'block': page // pages_per_block, 'page': page % pages_per_block,
+                          'duration': round(duration, 6)}
+                for event in self.EVENTS:
+                    when = data_end if event == 'data_end' else events.get(event)
+                    record[event] = None if when is None else round(when - self.start, 6)
+                record.update(counters)
+                self.file.write(json.dumps(record) + "\n")
+
+        self.pending = []
+
+    def write_textfile(self) -> None:
+        labels = 'device="{}"'.format(self.device.replace('\\', '\\\\').replace('"', '\\"'))
+        lines = [
+            "# HELP cfedump_pages_total Pages read",
+            "# TYPE cfedump_pages_total counter",
+            "cfedump_pages_total{{{}}} {}".format(labels, self.pages),
+            "# HELP cfedump_duration_seconds Time spent dumping",
+            "# TYPE cfedump_duration_seconds gauge",
+            "cfedump_duration_seconds{{{}}} {:.6f}".format(labels, self.last_page - self.start),
+        ]
+        for counter, value in self.totals.items():
+            lines += ["# TYPE cfedump_{}_total counter".format(counter),
+                      "cfedump_{}_total{{{}}} {}".format(counter, labels, value)]
+
+        lines += ["# HELP cfedump_phase_seconds Time spent in each phase of the page reads",
+                  "# TYPE cfedump_phase_seconds summary"]
+        for name, (total, count) in self.phases.items():
+            lines += ['cfedump_phase_seconds_sum{{{},phase="{}"}} {:.6f}'.format(labels, name, total),
+                      'cfedump_phase_seconds_count{{{},phase="{}"}} {}'.format(labels, name, count)]
+
+        # Written to a temporary file first, so that the collector never sees it half written
+        with open(self.path + ".tmp", 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(self.path + ".tmp", self.path)
+
+    def close(self) -> None:
+        self.finish_command()
+        if self.file:
+            self.file.close()
+        else:
+            self.write_textfile()
+
+
+class PortTap:
+    """
+    Wraps a serial port or input file, handing the data read from it to
+    `received`, and the data written to it to `sent` if given. Everything
+    else is passed through.
+    """
+
+    def __init__(self, port, received: Callable[[bytes], None], sent: Callable[[bytes], None] = None):
+        object.__setattr__(self, 'port', port)
+        object.__setattr__(self, 'on_received', received)
+        object.__setattr__(self, 'on_sent', sent)
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.port, name, value)
+
+    def _received(self, data: bytes) -> bytes:
+        if data:
+            self.on_received(data)
+        return data
+
+    def read(self, *a, **kw) -> bytes:
+        return self._received(self.port.read(*a, **kw))
+
+    def readline(self, *a, **kw) -> bytes:
+        return self._received(self.port.readline(*a, **kw))
+
+    def read_until(self, *a, **kw) -> bytes:
+        return self._received(self.port.read_until(*a, **kw))
+
+    def __iter__(self):
+        for line in self.port:
+            self.on_received(line)
+            yield line
+
+    def write(self, data: bytes) -> int:
+        if self.on_sent is not None:
+            self.on_sent(data)
+        return self.port.write(data)
+
+    def __enter__(self):
+        self.port.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self.port.__exit__(*exc)
+
+
+class MeteredPort(PortTap):
+    """
+    Wraps the serial port or input file of a parser, reporting the data going
+    through it to a DumpMetrics.
+    """
+
+    def __init__(self, port, metrics: DumpMetrics):
+        super().__init__(port, metrics.received, metrics.sent)
+        object.__setattr__(self, 'metrics', metrics)
+
+
+class CaptureWriter:
+    """
+    Capture of the raw data received from the console, written to `path` and
+    compressed according to its extension: .gz, .xz, or .zst (which needs the
+    zstandard module). Anything else is written as is.
+
+    Data is collected in chunks of CAPTURE_CHUNK_SIZE bytes, which are
+    compressed and written out in order by a background thread. If it falls
+    behind by CAPTURE_MAX_PENDING chunks, writing waits for it.
+    """
+    FORMATS = {'.gz': 'gzip', '.xz': 'xz', '.zst': 'zstd'}
+
+    def __init__(self, path: str):
+        self.path = path
+        self.format = self.FORMATS.get(os.path.splitext(path)[1])
+        self.compressor = self.make_compressor(self.format)
+        self.file = open(path, 'wb')
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._buf = bytearray()
+        self._jobs = deque()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @staticmethod
+    def make_compressor(fmt: str):
+        if fmt == 'gzip':
+            # wbits 31 makes a gzip stream, readable by gzip.open and gunzip
+            return zlib.compressobj(6, zlib.DEFLATED, 31)
+        if fmt == 'xz':
+            return lzma.LZMACompressor()
+        if fmt == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("Compressing captures with zstd needs the zstandard module")
+            return zstandard.ZstdCompressor().compressobj()
+        return None
+
+    def write(self, data: bytes) -> None:
+        self._buf += data
+        self.bytes_in += len(data)
+        if len(self._buf) >= CAPTURE_CHUNK_SIZE:
+            self._submit()
+
+    def _submit(self, final: bool = False) -> None:
+        if self._buf or final:
+            self._jobs.append(self.executor.submit(self._write_out, bytes(self._buf), final))
+            self._buf.clear()
+
+        while len(self._jobs) > CAPTURE_MAX_PENDING or self._jobs and self._jobs[0].done():
+            self._jobs.popleft().result()
+
+    def _write_out(self, data: bytes, final: bool) -> None:
+        if self.compressor:
+            data = self.compressor.compress(data)
+            if final:
+                data += self.compressor.flush()
+        self.file.write(data)
+        self.bytes_out += len(data)
+
+    def stats(self) -> str:
+        return "{} received, {} written to {}".format(format_size(self.bytes_in), format_size(self.bytes_out),
+                                                      self.path)
+
+    def close(self) -> None:
+        """
+        Write out and compress everything left, raising any error that
+        happened in the background.
+        """
+        try:
+            self._submit(final=True)
+            while self._jobs:
+                self._jobs.popleft().result()
+        finally:
+            self.executor.shutdown()
+            self.file.close()
+
+
+class CapturePort(PortTap):
+    """
+    Wraps a serial port, copying everything read from it to a CaptureWriter.
+    """
+
+    def __init__(self, port, capture: CaptureWriter):
+        super().__init__(port, capture.write)
+        object.__setattr__(self, 'capture', capture)
+
 
 class CFEParserBase:
     def __init__(self, printer: PrettyPrinter, block_size: int = BLOCK_SIZE, page_size: int = PAGE_SIZE,
-                 nand_size: int = NAND_SIZE, max_retries: int = MAX_RETRIES):
+                 nand_size: int = NAND_SIZE, max_retries: int = MAX_RETRIES, sync_mode: str = SYNC_PROMPT,
+                 prompt_timeout: float = PROMPT_TIMEOUT, window: int = WINDOW, oob_size: int = 0):
+        if sync_mode not in SYNC_MODES:
+            raise ValueError("Unknown sync mode '{}'".format(sync_mode))
+
         self.printer = printer
         self.max_retries = max_retries
         self.block_size = block_size
         self.page_size = page_size
         self.nand_size = nand_size
+        self.sync_mode = sync_mode
+        self.prompt_timeout = prompt_timeout
+        self.window = window
+        self.oob_size = oob_size
+        self.bad_blocks = set()
+        self.metrics = None
 
     def _read(self, *a, **kw) -> bytes:
         raise NotImplementedError
@@ -191,15 +1103,118 @@ class CFEParserBase:
     def wait_for_prompt(self):
         raise NotImplementedError
 
+    def sync_prompt(self) -> None:
+        raise NotImplementedError
+
+    def enable_metrics(self, metrics: DumpMetrics) -> None:
+        """
+        Start recording metrics. Subclasses wrap their port in a MeteredPort.
+        """
+        self.metrics = metrics
+
+    def mark(self, event: str) -> None:
+        if self.metrics is not None:
+            self.metrics.mark(event)
+
     def eat_junk(self) -> None:
         while self._read(1):
             pass
 
-    def parse_pages_bulk(self) -> Generator[bytes, None, None]:
-        while not self._readline().startswith(b"-----"):
+    def sync(self) -> None:
+        """
+        Skip whatever follows a command's useful output, up to the point
+        where CFE is ready for the next command.
+        """
+        if self.sync_mode == SYNC_PROMPT:
+            self.sync_prompt()
+        else:
+            self.eat_junk()
+        self.mark('prompt')
+
+    def decode_lines(self, lines: List[bytes]) -> Tuple[Tuple[int, ...], bytes]:
+        try:
+            return parse_serial_lines(lines)
+        except ValueError:
             pass
-        buf = b''
+
+        # Slow path: decode line by line to report and drop the offending ones
+        addrs = []
+        chunks = []
+        for line in lines:
+            # noinspection PyBroadException
+            try:
+                addr, data = parse_serial_line(line.decode())
+                addrs.append(addr)
+                chunks.append(data)
+            except Exception:
+                self.printer.msg("Error caused by line: '{}'".format(line.decode(errors='replace')))
+                self.printer.exc()
+
+        return tuple(addrs), b''.join(chunks)
+
+    def assemble_lines(self, buf: memoryview, lines: List[bytes], last_addr: int) -> Tuple[int, int]:
+        """
+        Decode lines into the preallocated page buffer, placing each line at
+        its address offset within the page. Returns the number of lines stored
+        and the last address seen.
+        """
+        addrs, data = self.decode_lines(lines)
+        if not addrs:
+            return 0, last_addr
+
+        # Fast path: a whole, contiguous page following the previous one
+        first = addrs[0]
+        if len(data) == len(buf) and first % self.page_size == 0 and \
+                (last_addr == -1 or first == last_addr + LINE_DATA_SIZE) and \
+                addrs == tuple(range(first, first + len(addrs) * LINE_DATA_SIZE, LINE_DATA_SIZE)):
+            buf[:] = data
+            return len(addrs), addrs[-1]
+
+        data = memoryview(data)
+        stored = 0
+        for i, addr in enumerate(addrs):
+            if addr <= last_addr:
+                continue
+            while last_addr != -1 and addr - last_addr > LINE_DATA_SIZE:
+                last_addr += LINE_DATA_SIZE
+                self.printer.msg('Address {} missing, padding with zeroes'.format(hex(last_addr)))
+            offset = addr % self.page_size
+            buf[offset:offset + LINE_DATA_SIZE] = data[i * LINE_DATA_SIZE:(i + 1) * LINE_DATA_SIZE]
+            stored += 1
+            last_addr = addr
+
+        return stored, last_addr
+
+    def section_page(self, header: bytes) -> int:
+        """
+        Page number in a page section header, or None if it can't be parsed.
+        """
+        m = page_header_regex.search(header)
+        if m is None:
+            return None
+        return int(m.group('block')) * (self.block_size // self.page_size) + int(m.group('page'))
+
+    def parse_page_sections(self, number: int = None) -> Generator[Tuple[memoryview, bool, int], None, None]:
+        """
+        Parse the output of a `dn` command, yielding every page along with
+        whether it was read cleanly (all of its lines present, well formed and
+        contiguous, and no read or ECC errors reported for it) and its number
+        from the section header, None if it couldn't be parsed. Stops after
+        `number` pages if given.
+
+        A page header showing up before the spare area marker ends the page
+        being read, which is reported as not clean, so that a lost marker
+        doesn't merge two pages.
+        """
+        bad = False
+        line = self._readline()
+        while not line.startswith(b"-----"):
+            bad = bad or line.startswith(BAD_PAGE_LINE_PREFIXES)
+            line = self._readline()
+        page = self.section_page(line)
+        lines = []
         last_addr = -1
+        count = 0
 
         for line in self._file():
             line = line.strip()
@@ -207,100 +1222,316 @@ class CFEParserBase:
             if not line:
                 continue
 
-            # Spare area. Yield and skip to next page
-            if line.startswith(b"-----") and b'spare area' in line:
-                yield buf
-                buf = b''
+            if line.startswith(ERROR_LINE_PREFIXES):
+                bad = bad or line.startswith(BAD_PAGE_LINE_PREFIXES)
+                continue
 
-                for line in self._file():
-                    if line.startswith(b"-----"):
-                        break
-                else:
-                    break
+            if not line.startswith(b"-----"):
+                lines.append(line)
                 continue
 
-            # noinspection PyBroadException
-            try:
-                addr, buf = parse_serial_line(line.decode())
-                if addr <= last_addr:
-                    continue
-                while last_addr != -1 and addr - last_addr > 16:
-                    last_addr += 16
-                    self.printer.msg('Address {} missing, padding with zeroes'.format(hex(last_addr)))
-                    yield b'\0' * 16
-                last_addr = addr
-            except Exception:
-                traceback.print_exc()
+            # End of the page: decode, yield and skip to the next one
+            spare = b'spare area' in line
+            self.mark('data_end')
+            buf = memoryview(bytearray(self.page_size + self.oob_size))
+            stored, last_addr = self.assemble_lines(buf[:self.page_size], lines, last_addr)
+            ok = spare and not bad and stored == len(lines) and stored * LINE_DATA_SIZE == self.page_size
+            stop, bad = None, False
+            if spare and self.oob_size:
+                spare_ok, stop, bad = self.read_spare(buf[self.page_size:])
+                ok = ok and spare_ok
+            yield buf, ok, page
+            lines = []
+            count += 1
 
-    def read_page(self, block: int, page: int) -> bytes:
-        buf = b''
-        main_area_read = False
-        last_addr = -1
+            if number is not None and count >= number:
+                if stop is None or PROMPT not in stop:
+                    self.sync()
+                else:
+                    self.mark('prompt')
+                return
 
-        self._read("dn {block} {page} 1\r\n".format(block=block, page=page).encode())
+            # Without its spare area marker, the page ended at the next one's header
+            if not spare:
+                page = self.section_page(line)
+                continue
 
-        while not self._readline().startswith(b"-----"):
-            pass
+            # The spare area reader may already have consumed the next header
+            if stop is not None and stop.startswith(b"-----"):
+                page = self.section_page(stop)
+                continue
 
-        while True:
-            line = self._readline().strip()
+            for line in self._file():
+                if line.startswith(b"-----"):
+                    page = self.section_page(line)
+                    break
+                bad = bad or line.startswith(BAD_PAGE_LINE_PREFIXES)
+            else:
+                break
 
-            if line.startswith(b"-----"):
+    def read_spare(self, buf: memoryview) -> Tuple[bool, bytes, bool]:
+        """
+        Read the spare area lines following a spare area marker into `buf`.
+
+        Returns whether it was filled completely, the line that ended it early
+        if any, and whether read errors were reported in the meantime (which
+        belong to the next page).
+        """
+        lines = []
+        bad = False
+        stop = None
+
+        # A spare area that isn't a whole number of lines ends part way through the last one
+        while len(lines) < -(-len(buf) // LINE_DATA_SIZE):
+            line = self._readline()
+            if not line:
                 break
+            line = line.strip()
 
-            # ignore Uncorrectable errors
-            if line.startswith(b"Uncorrectable ECC Error"):
+            if not line:
                 continue
 
-            # ignore more errors
-            if line.startswith(b"nand_flash_read_buf(): Att"):
+            if line.startswith(ERROR_LINE_PREFIXES):
+                bad = bad or line.startswith(BAD_PAGE_LINE_PREFIXES)
                 continue
 
-            if line.startswith(b"Error reading block"):
-                continue
+            if line[LINE_ADDR_END:LINE_ADDR_END + 1] != b":":
+                stop = line
+                break
+
+            lines.append(line)
 
-            #danitool begin: eat crashing line
-            if line.startswith(b"Correctable ECC Error detected"):
+        # Spare addresses restart from zero or continue the page's, so lines are stored in order
+        addrs, data = self.decode_lines(lines)
+        buf[:len(data)] = data[:len(buf)]
+
+        return len(addrs) == len(lines) and len(data) >= len(buf), stop, bad
+
+    def parse_pages_bulk(self, number: int = None) -> Generator[memoryview, None, None]:
+        for buf, _, _ in self.parse_page_sections(number):
+            yield buf
+
+    def read_page(self, block: int, page: int) -> memoryview:
+        lines = []
+
+        self._write("dn {block} {page} 1\r\n".format(block=block, page=page).encode())
+
+        line = self._readline()
+        while not line.startswith(b"-----"):
+            line = self._readline()
+
+        # Any other page's section (e.g. the next one in a capture missing a retry) isn't taken for this one
+        pages_per_block = self.block_size // self.page_size
+        found = self.section_page(line)
+        if found != block * pages_per_block + page:
+            raise IOError("Expected the section of block {} page {}, got {}"
+                          .format(block, page, 'no page number' if found is None else
+                                  "block {} page {}".format(*divmod(found, pages_per_block))))
+
+        while True:
+            line = self._readline().strip()
+
+            if line.startswith(b"-----"):
+                break
+
+            if line.startswith(ERROR_LINE_PREFIXES):
                 continue
-            #danitool end
 
             if len(line) == 0:
                 continue
 
-            try:
-                addr, buf_temp = parse_serial_line(line.decode())
-                buf += buf_temp
-            except UnicodeDecodeError:
-                traceback.print_exc()
+            lines.append(line)
+
+        self.mark('data_end')
+        buf = memoryview(bytearray(self.page_size + self.oob_size))
+        stored, _ = self.assemble_lines(buf[:self.page_size], lines, -1)
 
-        if len(buf) != self.page_size:
+        if stored * LINE_DATA_SIZE != self.page_size:
             raise IOError("Read page size ({}) different from expected size ({})"
-                          .format(len(buf), self.page_size))
+                          .format(stored * LINE_DATA_SIZE, self.page_size))
 
-        self.eat_junk()
+        if self.oob_size:
+            spare_ok, stop, _ = self.read_spare(buf[self.page_size:])
+            if not spare_ok:
+                raise IOError("Incomplete spare area")
+            if stop is not None and PROMPT in stop:
+                self.mark('prompt')
+                return buf
+
+        self.sync()
 
         return buf
 
-    def read_pages(self, block: int, page_start: int, number: int) -> Generator[bytes, None, None]:
-        for page in range(page_start, page_start + number):
-            retries = 0
+    def read_page_retry(self, block: int, page: int) -> memoryview:
+        retries = 0
 
-            while retries < self.max_retries:
-                try:
-                    yield self.read_page(block, page)
-                    break
-                except Exception:
-                    print("Block {} page {} read failed, retrying.".format(block, page))
-                    retries += 1
-                    self.printer.exc()
+        while retries < self.max_retries:
+            try:
+                return self.read_page(block, page)
+            except Exception:
+                self.printer.msg("Block {} page {} read failed, retrying.".format(block, page))
+                retries += 1
+                if self.metrics is not None:
+                    self.metrics.retry()
+                self.printer.exc()
+
+        raise IOError("Max number of page read retries exceeded")
+
+    def bad_page(self) -> memoryview:
+        # Erased main area, and a spare area carrying a bad block marker
+        return memoryview(bytearray(b'\xff' * self.page_size + b'\0' * self.oob_size))
+
+    def read_pages(self, block: int, page_start: int, number: int,
+                   window: int = None) -> Generator[memoryview, None, None]:
+        """
+        Read pages, `window` (by default the parser's) at a time, filling the
+        ones in bad blocks instead of reading them.
+        """
+        window = window or self.window
+        pages_per_block = self.block_size // self.page_size
+        first = block * pages_per_block + page_start
+        end = first + number
+
+        # Split the range into runs of good and bad blocks; bad ones aren't read
+        while first < end:
+            bad = first // pages_per_block in self.bad_blocks
+            run_end = first
+            while run_end < end and (run_end // pages_per_block in self.bad_blocks) == bad:
+                run_end = (run_end // pages_per_block + 1) * pages_per_block
+            run_end = min(run_end, end)
+
+            if bad:
+                for _ in range(first, run_end):
+                    yield self.bad_page()
+            elif window > 1:
+                yield from self.read_pages_windowed(first // pages_per_block, first % pages_per_block, run_end - first,
+                                                    window)
             else:
-                raise IOError("Max number of page read retries exceeded")
+                for i in range(first, run_end):
+                    yield self.read_page_retry(i // pages_per_block, i % pages_per_block)
+
+            first = run_end
 
-    def read_pages_bulk(self, block: int, page_start: int, number: int) -> Generator[bytes, None, None]:
+    def read_markers(self, block: int) -> bytes:
+        """
+        Read the bad block markers (first spare area byte) of the first pages
+        of a block with a single `dn`. CFE can't dump the spare area alone, so
+        the main area lines still come through, but they're skipped undecoded.
+        """
+        self._write("dn {block} 0 {number}\r\n".format(block=block, number=BBM_PAGES).encode())
+
+        markers = bytearray()
+        spare = False
+        for line in self._file():
+            line = line.strip()
+            if line.startswith(b"-----"):
+                spare = b'spare area' in line
+            elif spare and line[LINE_ADDR_END:LINE_ADDR_END + 1] == b":":
+                # Only the first spare line holds the marker
+                spare = False
+                _, data = self.decode_lines([line])
+                if not data:
+                    break
+                markers += data[:1]
+                if len(markers) == BBM_PAGES:
+                    break
+            elif PROMPT in line:
+                raise IOError("Output of block {} ended before its bad block markers".format(block))
+
+        self.sync()
+
+        if len(markers) != BBM_PAGES:
+            raise IOError("Read {} bad block markers instead of {}".format(len(markers), BBM_PAGES))
+
+        return bytes(markers)
+
+    def is_bad_block(self, block: int) -> bool:
+        retries = 0
+
+        while retries < self.max_retries:
+            try:
+                return self.read_markers(block) != b'\xff' * BBM_PAGES
+            except Exception:
+                self.printer.msg("Block {} bad block markers read failed, retrying.".format(block))
+                retries += 1
+                if self.metrics is not None:
+                    self.metrics.retry()
+                self.printer.exc()
+
+        self.printer.msg("Block {} can't be read, marking it as bad".format(block))
+        return True
+
+    def scan_bad_blocks(self) -> List[int]:
+        """
+        Build a bad block table by checking the factory bad block marker (first
+        spare area byte) of the first pages of every block.
+        """
+        bad = []
+        blocks = self.nand_size // self.block_size
+
+        for block in range(blocks):
+            self.printer.print("\r Scanning for bad blocks [{}/{}] [{} bad]".format(block, blocks, len(bad)))
+            if self.is_bad_block(block):
+                bad.append(block)
+
+        self.printer.msg("\r Found {} bad blocks".format(len(bad)))
+        return bad
+
+    def read_pages_bulk(self, block: int, page_start: int, number: int) -> Generator[memoryview, None, None]:
         self._write("dn {block} {page} {number}\r\n".format(block=block, page=page_start, number=number).encode())
-        yield from self.parse_pages_bulk()
+        yield from self.parse_pages_bulk(number)
+
+    def read_pages_windowed(self, block: int, page_start: int, number: int,
+                            window: int = None) -> Generator[memoryview, None, None]:
+        """
+        Read pages with one `dn` command per `window` pages (by default the
+        parser's), verifying each page as it arrives and re-reading only the
+        ones that failed, one at a time with retries.
+        """
+        window = window or self.window
+        pages_per_block = self.block_size // self.page_size
+        first = block * pages_per_block + page_start
+        end = first + number
+
+        while first < end:
+            count = min(window, end - first)
+            self._write("dn {block} {page} {number}\r\n"
+                        .format(block=first // pages_per_block, page=first % pages_per_block, number=count).encode())
+
+            # Pages are placed by the number in their header, and yielded as
+            # soon as all the ones before them are there. Those that failed,
+            # didn't come or came with another number are re-read afterwards.
+            held = [None] * count
+            done = 0
+            received = 0
+            for buf, ok, page in self.parse_page_sections(count):
+                received += 1
+                i = -1 if page is None else page - first
+                if not 0 <= i < count or held[i] is not None:
+                    self.printer.msg("Unexpected page section ({}) in the output of the window at block {} "
+                                     "page {}".format('no page number' if page is None else
+                                                      "block {} page {}".format(*divmod(page, pages_per_block)),
+                                                      first // pages_per_block, first % pages_per_block))
+                    continue
+                if ok:
+                    held[i] = buf
+                while done < count and held[done] is not None:
+                    yield held[done]
+                    done += 1
+
+            if received < count:
+                self.sync()
+
+            for i, buf in enumerate(held[done:], first + done):
+                if buf is None:
+                    self.printer.msg("Block {} page {} failed verification, re-reading"
+                                     .format(i // pages_per_block, i % pages_per_block))
+                    buf = self.read_page_retry(i // pages_per_block, i % pages_per_block)
+                yield buf
+
+            first += count
 
-    def read_block(self, block: int) -> Generator[bytes, None, None]:
+    def read_block(self, block: int) -> Generator[memoryview, None, None]:
         count = 0
         for i in self.read_pages(block, 0, self.block_size // self.page_size):
             yield i
@@ -311,24 +1542,221 @@ class CFEParserBase:
             raise IOError("Read block size ({}) different from expected size ({})"
                           .format(count, expected))
 
-    def read_blocks(self, block: int, number: int) -> Generator[bytes, None, None]:
+    def read_blocks(self, block: int, number: int) -> Generator[memoryview, None, None]:
         for block in range(block, block + number):
             yield from self.read_block(block)
 
-    def read_nand(self) -> Generator[bytes, None, None]:
+    def read_nand(self) -> Generator[memoryview, None, None]:
         for block in range(self.nand_size // self.block_size):
             yield from self.read_block(block)
 
-    def read_nand_bulk(self) -> Generator[bytes, None, None]:
+    def read_nand_bulk(self) -> Generator[memoryview, None, None]:
         yield from self.read_pages_bulk(0, 0, self.nand_size // self.page_size)
 
 
+class PortReader:
+    """
+    Drains a serial port from a dedicated thread into a buffer of up to
+    `capacity` bytes, so that the port is read continuously however long
+    parsing or writing the output takes. Offers the read methods of
+    serial.Serial on the buffered data, honouring its own `timeout`; anything
+    else is passed through to the port.
+
+    If the buffer fills up, the thread stops reading until there is room
+    again: the times it stalled are counted, along with the peak amount of
+    data buffered.
+
+    The port can't be reconfigured while the thread is in the middle of a
+    read, so the thread is stopped around resetting its input buffer or
+    setting any of its attributes (e.g. the baud rate).
+    """
+
+    def __init__(self, port: serial.Serial, capacity: int = PIPELINE_BUFFER_SIZE):
+        local = {
+            'port': port,
+            'capacity': capacity,
+            'timeout': port.timeout,
+            'bytes_read': 0,
+            'peak': 0,
+            'stalls': 0,
+            'stall_time': 0.0,
+            '_buf': bytearray(),
+            '_start': 0,
+            '_cond': threading.Condition(),
+            '_error': None,
+            '_closed': False,
+            '_paused': False,
+            '_thread': threading.Thread(target=self._run, daemon=True),
+        }
+        for name, value in local.items():
+            object.__setattr__(self, name, value)
+
+        # The thread only needs to wake up now and then to check whether it should stop
+        port.timeout = READER_POLL_TIMEOUT
+        self._thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__:
+            object.__setattr__(self, name, value)
+            return
+
+        self.pause()
+        try:
+            setattr(self.port, name, value)
+        finally:
+            self.resume()
+
+    def pause(self) -> None:
+        """
+        Stop the reader thread, waiting for it to finish its current read.
+        """
+        with self._cond:
+            self._paused = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def resume(self) -> None:
+        """
+        Start a new reader thread after pause().
+        """
+        with self._cond:
+            self._paused = False
+            if self._closed:
+                return
+            object.__setattr__(self, '_thread', threading.Thread(target=self._run, daemon=True))
+        self._thread.start()
+
+    def _run(self) -> None:
+        # noinspection PyBroadException
+        try:
+            while not self._closed and not self._paused:
+                data = self.port.read(max(1, self.port.in_waiting))
+                if not data:
+                    continue
+
+                with self._cond:
+                    self.bytes_read += len(data)
+                    while data and not self._closed:
+                        # Hand over whatever fits, the rest once there is room
+                        room = self.capacity - (len(self._buf) - self._start)
+                        # When pausing, whatever was read is handed over in full rather than lost
+                        if self._paused:
+                            room = len(data)
+                        if room <= 0:
+                            self.stalls += 1
+                            start = time.monotonic()
+                            while len(self._buf) - self._start >= self.capacity and not self._closed \
+                                    and not self._paused:
+                                self._cond.wait()
+                            self.stall_time += time.monotonic() - start
+                            continue
+
+                        self._buf += data[:room]
+                        data = data[room:]
+                        self.peak = max(self.peak, len(self._buf) - self._start)
+                        self._cond.notify_all()
+        except Exception as e:
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
+
+    def _take(self, end: int) -> bytes:
+        data = bytes(self._buf[self._start:end])
+        self._start = end
+        # Drop what was read once it's most of the buffer
+        if self._start > len(self._buf) // 2:
+            del self._buf[:self._start]
+            self._start = 0
+        self._cond.notify_all()
+        return data
+
+    def read_until(self, expected: bytes = b'\n', size: int = None) -> bytes:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+
+        with self._cond:
+            search = self._start
+            while True:
+                if self._error:
+                    raise self._error
+
+                end = None
+                if expected:
+                    found = self._buf.find(expected, search)
+                    if found >= 0:
+                        end = found + len(expected)
+                    else:
+                        search = max(self._start, len(self._buf) - len(expected) + 1)
+                if size is not None and len(self._buf) - self._start >= size and \
+                        (end is None or end - self._start > size):
+                    end = self._start + size
+                if end is not None:
+                    return self._take(end)
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0 or self._closed:
+                    return self._take(len(self._buf))
+                self._cond.wait(remaining)
+
+    def read(self, size: int = 1) -> bytes:
+        return self.read_until(b'', size)
+
+    def readline(self, size: int = None) -> bytes:
+        return self.read_until(b'\n', size)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    @property
+    def in_waiting(self) -> int:
+        with self._cond:
+            return len(self._buf) - self._start
+
+    def reset_input_buffer(self) -> None:
+        self.pause()
+        try:
+            self.port.reset_input_buffer()
+            with self._cond:
+                del self._buf[:]
+                self._start = 0
+                self._cond.notify_all()
+        finally:
+            self.resume()
+
+    def stats(self) -> str:
+        return "{} read, up to {} buffered, reader stalled {} times ({:.1f}s)".format(
+            format_size(self.bytes_read), format_size(self.peak), self.stalls, self.stall_time)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self.port.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 class CFECommunicator(CFEParserBase):
     # noinspection PyShadowingNames
     def __init__(self, serial: serial.Serial, block_size: int = BLOCK_SIZE, page_size: int = PAGE_SIZE,
-                 nand_size: int = NAND_SIZE, max_retries: int = MAX_RETRIES, printer: PrettyPrinter = None):
-        super().__init__(printer, block_size, page_size, nand_size, max_retries)
+                 nand_size: int = NAND_SIZE, max_retries: int = MAX_RETRIES, printer: PrettyPrinter = None,
+                 sync_mode: str = SYNC_PROMPT, prompt_timeout: float = PROMPT_TIMEOUT, window: int = WINDOW,
+                 oob_size: int = 0):
+        super().__init__(printer, block_size, page_size, nand_size, max_retries, sync_mode, prompt_timeout, window,
+                         oob_size)
         self.ser = serial
+        self.store = None
 
     def _read(self, *a, **kw) -> bytes:
         if not type(*a) is int:
@@ -345,6 +1773,85 @@ class CFECommunicator(CFEParserBase):
     def _file(self):
         return self.ser
 
+    def enable_metrics(self, metrics: DumpMetrics) -> None:
+        super().enable_metrics(metrics)
+        self.ser = MeteredPort(self.ser, metrics)
+
+    def enable_capture(self, capture: CaptureWriter) -> None:
+        """
+        Copy everything received from the console to a capture, which can be
+        decoded again later with CFEParser.
+        """
+        self.ser = CapturePort(self.ser, capture)
+
+    def enable_store(self, store: PageStore) -> None:
+        """
+        Take pages from a page store when they're in it, and store the ones
+        read cleanly from the device.
+        """
+        self.store = store
+
+    def read_stored(self, read: Callable[[int, int], Generator[Tuple[memoryview, bool], None, None]], block: int,
+                    page_start: int, number: int) -> Generator[memoryview, None, None]:
+        """
+        Read pages through the page store: those in it are taken from there,
+        and every run of missing ones is read with `read(first, count)`, which
+        yields every page along with whether it can be stored.
+        """
+        pages_per_block = self.block_size // self.page_size
+        first = block * pages_per_block + page_start
+        end = first + number
+
+        while first < end:
+            data = self.store.get(first)
+            if data is not None:
+                yield memoryview(bytearray(data))
+                first += 1
+                continue
+
+            run_end = first + 1
+            while run_end < end and not self.store.has(run_end):
+                run_end += 1
+
+            for i, (buf, ok) in enumerate(read(first, run_end - first), first):
+                # Bad block pages are made up, not read
+                if ok and i // pages_per_block not in self.bad_blocks:
+                    self.store.put(i, buf)
+                yield buf
+            first = run_end
+
+    def read_pages(self, block: int, page_start: int, number: int,
+                   window: int = None) -> Generator[memoryview, None, None]:
+        if self.store is None:
+            yield from super().read_pages(block, page_start, number, window)
+            return
+
+        pages_per_block = self.block_size // self.page_size
+
+        def read(first: int, count: int) -> Generator[Tuple[memoryview, bool], None, None]:
+            # Pages are verified, and re-read if needed
+            for buf in super(CFECommunicator, self).read_pages(first // pages_per_block, first % pages_per_block,
+                                                               count, window):
+                yield buf, True
+
+        yield from self.read_stored(read, block, page_start, number)
+
+    def read_pages_bulk(self, block: int, page_start: int, number: int) -> Generator[memoryview, None, None]:
+        if self.store is None:
+            yield from super().read_pages_bulk(block, page_start, number)
+            return
+
+        pages_per_block = self.block_size // self.page_size
+
+        def read(first: int, count: int) -> Generator[Tuple[memoryview, bool], None, None]:
+            # Pages aren't re-read, but only the clean ones, where they were expected, are stored
+            self._write("dn {block} {page} {number}\r\n"
+                        .format(block=first // pages_per_block, page=first % pages_per_block, number=count).encode())
+            for i, (buf, ok, page) in enumerate(self.parse_page_sections(count), first):
+                yield buf, ok and page == i
+
+        yield from self.read_stored(read, block, page_start, number)
+
     def wait_for_prompt(self) -> None:
         self.printer.msg("Waiting for a prompt...")
         while True:
@@ -354,12 +1861,828 @@ class CFECommunicator(CFEParserBase):
                 self.eat_junk()
                 return
 
+    def await_prompt(self, timeout: float) -> bool:
+        deadline = time.time() + timeout
+        tail = b''
+
+        while time.time() < deadline:
+            data = tail + self.ser.read_until(PROMPT)
+            if PROMPT in data:
+                return True
+            tail = data[-(len(PROMPT) - 1):]
+
+        return False
+
+    def sync_prompt(self) -> None:
+        if not self.await_prompt(self.prompt_timeout):
+            self.printer.msg("Prompt not seen within {}s, draining input".format(self.prompt_timeout))
+            self.eat_junk()
+
+    def probe(self) -> bool:
+        self._write(b"\r\n")
+        return self.await_prompt(self.prompt_timeout)
+
+    def set_baudrate(self, baudrate: int, command: str) -> None:
+        """
+        Ask CFE to switch its console to `baudrate` using `command` (formatted
+        with `baudrate`), then switch the local port.
+        """
+        self._write((command.format(baudrate=baudrate) + "\r\n").encode())
+        self.ser.flush()
+        time.sleep(BAUD_SETTLE_TIME)
+        self.ser.reset_input_buffer()
+        self.ser.baudrate = baudrate
+
+    def escalate_baudrate(self, baudrates: List[int], command: str) -> int:
+        """
+        Try to move the console to the first of `baudrates` that works, checking
+        each one by reading back a page read at the current rate. Falls back to
+        the current rate if none does. Returns the rate in use.
+        """
+        original = int(self.ser.baudrate)
+        reference = bytes(self.read_page_retry(0, 0))
+
+        for baudrate in baudrates:
+            self.printer.msg("Trying {} baud".format(baudrate))
+            self.set_baudrate(baudrate, command)
+
+            # noinspection PyBroadException
+            try:
+                if self.probe() and bytes(self.read_page(0, 0)) == reference:
+                    self.printer.msg("Switched to {} baud".format(baudrate))
+                    return baudrate
+            except Exception:
+                self.printer.exc()
+
+            # Whether CFE switched or not, this leaves both ends at the original rate
+            self.set_baudrate(original, command)
+            if not self.probe():
+                raise IOError("CFE console lost while trying {} baud".format(baudrate))
+
+        self.printer.msg("Staying at {} baud".format(original))
+        return original
+
+
+class AsyncSerialTransport:
+    """
+    Reads a serial port from the running event loop through its file
+    descriptor, buffering the input for line/prompt oriented reads with
+    per-call timeouts. Once the port reports an error or end of file, it's no
+    longer read and every wait raises the error.
+    """
+
+    # noinspection PyShadowingNames
+    def __init__(self, serial: serial.Serial):
+        self.ser = serial
+        self.fd = serial.fileno()
+        self.buf = bytearray()
+        self._waiter = None
+        self._error = None
+        self._loop = asyncio.get_running_loop()
+        os.set_blocking(self.fd, False)
+        self._loop.add_reader(self.fd, self._on_readable)
+
+    def _on_readable(self) -> None:
+        try:
+            data = os.read(self.fd, 65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._fail(e)
+            return
+
+        if not data:
+            self._fail(IOError("End of file on the serial port"))
+            return
+
+        self.buf += data
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _fail(self, error: Exception) -> None:
+        # The descriptor would otherwise be reported readable (EOF) or failing (EIO) over and over
+        self._loop.remove_reader(self.fd)
+        self._error = error
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_exception(error)
+
+    async def _wait(self, deadline: float) -> bool:
+        if self._error:
+            raise self._error
+
+        timeout = deadline - self._loop.time()
+        if timeout <= 0:
+            return False
+
+        self._waiter = self._loop.create_future()
+        try:
+            await asyncio.wait_for(self._waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiter = None
+
+    async def read_until(self, expected: bytes, timeout: float) -> bytes:
+        """
+        Read up to and including `expected`, or whatever arrived if it doesn't
+        show up within `timeout` seconds.
+        """
+        deadline = self._loop.time() + timeout
+        start = 0
+
+        while True:
+            i = self.buf.find(expected, start)
+            if i >= 0:
+                data = bytes(self.buf[:i + len(expected)])
+                del self.buf[:i + len(expected)]
+                return data
+
+            start = max(0, len(self.buf) - len(expected) + 1)
+            if not await self._wait(deadline):
+                data = bytes(self.buf)
+                self.buf.clear()
+                return data
+
+    async def readline(self, timeout: float) -> bytes:
+        return await self.read_until(b"\n", timeout)
+
+    async def read_idle(self, timeout: float, first_timeout: float) -> bytes:
+        """
+        Read until no data arrives for `timeout` seconds, waiting up to
+        `first_timeout` for it to start.
+        """
+        if not self.buf:
+            await self._wait(self._loop.time() + first_timeout)
+        while await self._wait(self._loop.time() + timeout):
+            pass
+        data = bytes(self.buf)
+        self.buf.clear()
+        return data
+
+    async def drain(self, timeout: float) -> None:
+        """
+        Discard input until none arrives for `timeout` seconds.
+        """
+        self.buf.clear()
+        while await self._wait(self._loop.time() + timeout):
+            self.buf.clear()
+
+    def write(self, data: bytes) -> int:
+        return self.ser.write(data)
+
+    def close(self) -> None:
+        self._loop.remove_reader(self.fd)
+
+
+class CommandOutputParser(CFEParserBase):
+    """
+    Parses the output of a command received beforehand, up to the prompt
+    following it, so that AsyncCFECommunicator shares the parsing of the
+    blocking communicators without any I/O happening in it. Running out of
+    output raises IOError.
+    """
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.output = io.BytesIO()
+
+    def feed(self, output: bytes) -> None:
+        self.output = io.BytesIO(output)
+
+    def _read(self, *a, **kw) -> bytes:
+        return self.output.read(*a, **kw)
+
+    def _write(self, *a, **kw) -> int:
+        return 0
+
+    def _readline(self, *a, **kw) -> bytes:
+        line = self.output.readline(*a, **kw)
+        if not line:
+            raise IOError("Command output ended early")
+        return line
+
+    def _file(self):
+        return self.output
+
+    def wait_for_prompt(self) -> None:
+        pass
+
+    def sync(self) -> None:
+        # The output ends at the prompt, there is nothing else to skip
+        self.output.seek(0, io.SEEK_END)
+
+
+class AsyncCFECommunicator:
+    """
+    asyncio counterpart of CFECommunicator. The output of every command is
+    received in full (up to the prompt, or until the console goes quiet in
+    the junk sync mode), then parsed by a CommandOutputParser, whose
+    geometry and bad blocks it shares. Every wait for data is bounded by
+    `prompt_timeout`, after which an IOError is raised.
+    """
+
+    def __init__(self, transport: AsyncSerialTransport, block_size: int = BLOCK_SIZE, page_size: int = PAGE_SIZE,
+                 nand_size: int = NAND_SIZE, max_retries: int = MAX_RETRIES, printer: PrettyPrinter = None,
+                 sync_mode: str = SYNC_PROMPT, prompt_timeout: float = PROMPT_TIMEOUT, oob_size: int = 0,
+                 timeout: float = 0.1):
+        self.parser = CommandOutputParser(printer, block_size, page_size, nand_size, max_retries, sync_mode,
+                                          prompt_timeout, WINDOW, oob_size)
+        self.transport = transport
+        self.timeout = timeout
+
+    def __getattr__(self, name):
+        return getattr(self.parser, name)
+
+    async def command(self, command: str) -> None:
+        """
+        Run a command, and hand its output to the parser.
+        """
+        self.transport.write((command + "\r\n").encode())
+
+        if self.sync_mode != SYNC_PROMPT:
+            output = await self.transport.read_idle(self.timeout, self.prompt_timeout)
+            if not output:
+                raise IOError("No data received for {}s".format(self.prompt_timeout))
+            self.parser.feed(output)
+            return
+
+        # However long the output is, data has to keep coming until the prompt
+        output = bytearray()
+        while True:
+            data = await self.transport.read_until(PROMPT, self.prompt_timeout)
+            if not data:
+                raise IOError("No data received for {}s".format(self.prompt_timeout))
+            output += data
+            if PROMPT in output[-len(data) - len(PROMPT):]:
+                break
+        self.parser.feed(output)
+
+    async def await_prompt(self, timeout: float) -> bool:
+        return PROMPT in await self.transport.read_until(PROMPT, timeout)
+
+    async def wait_for_prompt(self) -> None:
+        self.printer.msg("Waiting for a prompt...")
+        while True:
+            self.transport.write(b"\r\n")
+            if await self.await_prompt(self.prompt_timeout):
+                await self.transport.drain(self.timeout)
+                return
+
+    async def sync(self) -> None:
+        if self.sync_mode == SYNC_PROMPT and await self.await_prompt(self.prompt_timeout):
+            return
+        await self.transport.drain(self.timeout)
+
+    async def retry(self, command: str, parse: Callable, what: str):
+        """
+        Run a command and parse its output with `parse`, up to max_retries
+        times, returning what it returns.
+        """
+        retries = 0
+
+        while retries < self.max_retries:
+            try:
+                await self.command(command)
+                return parse()
+            except Exception:
+                self.printer.msg("{} read failed, retrying.".format(what))
+                retries += 1
+                self.printer.exc()
+                await self.transport.drain(self.timeout)
+
+        raise IOError("{}: max number of read retries exceeded".format(what))
+
+    async def read_page(self, block: int, page: int) -> memoryview:
+        await self.command("dn {block} {page} 1".format(block=block, page=page))
+        return self.parser.read_page(block, page)
+
+    async def read_page_retry(self, block: int, page: int) -> memoryview:
+        return await self.retry("dn {block} {page} 1".format(block=block, page=page),
+                                lambda: self.parser.read_page(block, page),
+                                "Block {} page {}".format(block, page))
+
+    async def is_bad_block(self, block: int) -> bool:
+        try:
+            markers = await self.retry("dn {block} 0 {number}".format(block=block, number=BBM_PAGES),
+                                       lambda: self.parser.read_markers(block),
+                                       "Block {} bad block markers".format(block))
+        except IOError:
+            self.printer.msg("Block {} can't be read, marking it as bad".format(block))
+            return True
+        return markers != b'\xff' * BBM_PAGES
+
+    async def scan_bad_blocks(self) -> List[int]:
+        bad = []
+        blocks = self.nand_size // self.block_size
+
+        for block in range(blocks):
+            self.printer.print("\r Scanning for bad blocks [{}/{}] [{} bad]".format(block, blocks, len(bad)))
+            if await self.is_bad_block(block):
+                bad.append(block)
+
+        self.printer.msg("\r Found {} bad blocks".format(len(bad)))
+        return bad
+
+    async def read_pages_bulk(self, block: int, page_start: int,
+                              number: int) -> AsyncGenerator[memoryview, None]:
+        """
+        Read pages with a single `dn` command. Its whole output (about three
+        times the size of the pages) is held in memory before it's parsed, so
+        this is only meant for a few pages: use read_pages for large reads.
+        """
+        await self.command("dn {block} {page} {number}".format(block=block, page=page_start, number=number))
+        for buf in self.parser.parse_pages_bulk(number):
+            yield buf
+
+    async def read_pages(self, block: int, page_start: int, number: int) -> AsyncGenerator[memoryview, None]:
+        pages_per_block = self.block_size // self.page_size
+        first = block * pages_per_block + page_start
+
+        for i in range(first, first + number):
+            if i // pages_per_block in self.bad_blocks:
+                yield self.bad_page()
+            else:
+                yield await self.read_page_retry(i // pages_per_block, i % pages_per_block)
+
+    async def read_nand(self) -> AsyncGenerator[memoryview, None]:
+        async for buf in self.read_pages(0, 0, self.nand_size // self.page_size):
+            yield buf
+
+
+class CaptureIndex:
+    """
+    Sidecar file recording where the section of every page starts in a
+    capture, and whether it looked clean, so that single pages can be read
+    without parsing the capture from the start. Built in one pass the first
+    time, and rebuilt whenever the capture changes.
+
+    Layout: header, then for every page of the NAND in order, the big-endian
+    offset of its section (including the error messages printed right before
+    it) and its status flags. Pages missing from the capture have all bits set.
+    """
+    header = struct.Struct(">4sIIQQ")
+    entry = struct.Struct(">QB")
+    magic = b"CFEI"
+    missing = 2 ** 64 - 1
+    # Status flags
+    ERROR = 1
+    INCOMPLETE = 2
+
+    def __init__(self, capture: str, page_size: int, pages_per_block: int, printer: PrettyPrinter):
+        self.path = capture + ".idx"
+        self.page_size = page_size
+        self.pages_per_block = pages_per_block
+        self.printer = printer
+
+        st = os.stat(capture)
+        fields = (self.magic, page_size, pages_per_block, st.st_size, st.st_mtime_ns)
+
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                if self.header.unpack(f.read(self.header.size)) == fields:
+                    self.table = bytearray(f.read())
+                    return
+            self.printer.msg("Index {} is out of date, rebuilding it".format(self.path))
+
+        with open(capture, 'rb') as f:
+            self.table = self.build(f)
+
+        with open(self.path, 'wb') as f:
+            f.write(self.header.pack(*fields))
+            f.write(self.table)
+
+    def build(self, f: BinaryIO) -> bytearray:
+        table = bytearray()
+        lines_per_page = self.page_size // LINE_DATA_SIZE
+        # The section being read: [offset, page number, status], and its number of data lines
+        section = None
+        lines = 0
+        in_main = False
+        # Error messages seen since the last spare area, which belong to the next page
+        errors_start = None
+        errors_bad = False
+
+        offset = 0
+        for line in f:
+            stripped = line.strip()
+
+            if stripped.startswith(b"-----"):
+                m = page_header_regex.search(stripped)
+                if b'spare area' in stripped:
+                    if in_main and lines != lines_per_page:
+                        section[2] |= self.INCOMPLETE
+                    in_main = False
+                elif m:
+                    if section:
+                        self.store(table, *section)
+                    page = int(m.group('block')) * self.pages_per_block + int(m.group('page'))
+                    section = [offset if errors_start is None else errors_start, page,
+                               self.ERROR if errors_bad else 0]
+                    lines = 0
+                    in_main = True
+                    errors_start, errors_bad = None, False
+                    if page % 1000 == 0:
+                        self.printer.print("\r Indexing capture [page {}]".format(page))
+
+            elif stripped.startswith(ERROR_LINE_PREFIXES):
+                bad = stripped.startswith(BAD_PAGE_LINE_PREFIXES)
+                if in_main:
+                    section[2] |= self.ERROR if bad else 0
+                else:
+                    errors_start = offset if errors_start is None else errors_start
+                    errors_bad = errors_bad or bad
+
+            elif stripped:
+                if in_main:
+                    lines += 1
+                else:
+                    errors_start, errors_bad = None, False
+
+            offset += len(line)
+
+        if section:
+            if in_main:
+                section[2] |= self.INCOMPLETE
+            self.store(table, *section)
+
+        indexed = sum(table[i] != 0xff for i in range(0, len(table), self.entry.size))
+        self.printer.msg("\r Indexed {} pages".format(indexed))
+        return table
+
+    def store(self, table: bytearray, offset: int, page: int, status: int) -> None:
+        # Pages read more than once (retries) keep the last clean section
+        end = (page + 1) * self.entry.size
+        if len(table) < end:
+            table += b'\xff' * (end - len(table))
+        old_offset, old_status = self.entry.unpack_from(table, page * self.entry.size)
+        if status == 0 or old_offset == self.missing or old_status != 0:
+            self.entry.pack_into(table, page * self.entry.size, offset, status)
+
+    def lookup(self, block: int, page: int) -> Tuple[int, int]:
+        """
+        Returns the offset of the section of a page in the capture, and its
+        status flags. Raises IOError if the page isn't in the capture.
+        """
+        i = (block * self.pages_per_block + page) * self.entry.size
+        offset, status = self.entry.unpack_from(self.table, i) if i < len(self.table) else (self.missing, 0)
+        if offset == self.missing:
+            raise IOError("Block {} page {} isn't in the capture".format(block, page))
+        return offset, status
+
+
+class MappedInput:
+    """
+    Read-only file object over a memory mapped capture, supporting what
+    CFEParser needs: line iteration, readline, read, seek and tell.
+
+    Lines are found by scanning the mapping for newlines a chunk at a time, so
+    memory use doesn't depend on the size of the capture.
+    """
+
+    def __init__(self, path: str):
+        self.name = path
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        # madvise isn't available everywhere (e.g. on Windows)
+        if self.size and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.mm.madvise(mmap.MADV_SEQUENTIAL)
+        self.pos = 0
+        # Lines of the chunk being read, and the position right after the last one returned
+        self._lines = []
+        self._index = 0
+        self._lines_pos = -1
+        # Where the chunk starts and ends, and where each of its lines starts (computed on seeks)
+        self._chunk = (0, 0)
+        self._offsets = None
+
+    def _fill(self) -> bool:
+        """
+        Split the chunk starting at the current position into lines, unless
+        that's where the current chunk is at. Returns False at the end.
+        """
+        if self._lines_pos == self.pos and self._index < len(self._lines):
+            return True
+        if self.pos >= self.size:
+            return False
+
+        # Seeked to another line of the chunk
+        if self._chunk[0] <= self.pos < self._chunk[1]:
+            if self._offsets is None:
+                self._offsets = list(itertools.accumulate(map(len, self._lines), initial=self._chunk[0]))
+            i = bisect.bisect_left(self._offsets, self.pos)
+            if self._offsets[i] == self.pos:
+                self._index = i
+                self._lines_pos = self.pos
+                return True
+
+        end = self.mm.rfind(b"\n", self.pos, self.pos + MMAP_CHUNK_SIZE)
+        if end < 0:
+            end = self.mm.find(b"\n", self.pos + MMAP_CHUNK_SIZE)
+        end = self.size if end < 0 else end + 1
+
+        self._lines = self.mm[self.pos:end].splitlines(True)
+        self._index = 0
+        self._lines_pos = self.pos
+        self._chunk = (self.pos, end)
+        self._offsets = None
+        return True
+
+    def __iter__(self):
+        while self._fill():
+            lines = self._lines
+            # Start over if something else read or seeked in the meantime, possibly past this chunk
+            while self._index < len(lines) and self._lines_pos == self.pos and lines is self._lines:
+                line = lines[self._index]
+                self._index += 1
+                self.pos += len(line)
+                self._lines_pos = self.pos
+                yield line
+
+    def readline(self, size: int = -1) -> bytes:
+        if size < 0:
+            if not self._fill():
+                return b''
+            line = self._lines[self._index]
+            self._index += 1
+            self.pos += len(line)
+            self._lines_pos = self.pos
+            return line
+
+        end = self.mm.find(b"\n", self.pos)
+        end = self.size if end < 0 else end + 1
+        end = min(end, self.pos + size)
+
+        line = self.mm[self.pos:end]
+        self.pos = end
+        return line
+
+    def read(self, size: int = -1) -> bytes:
+        end = self.size if size < 0 else min(self.size, self.pos + size)
+        data = self.mm[self.pos:end]
+        self.pos = end
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = max(0, min(offset, self.size))
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def close(self) -> None:
+        if self.size:
+            self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CompressedInput:
+    """
+    Read-only file object over a gzip, xz or zstd compressed capture (the
+    latter needs the zstandard module), supporting what CFEParser needs
+    without seeking: line iteration, readline, read and tell, in terms of the
+    decompressed data.
+
+    The capture is decompressed by a background thread, in chunks of about
+    DECOMPRESS_CHUNK_SIZE bytes ending at a line boundary, which are queued up
+    to DECOMPRESS_QUEUE_SIZE ahead of the parser.
+    """
+    MAGICS = {b'\x1f\x8b': 'gzip', b'\xfd7zXZ\x00': 'xz', b'\x28\xb5\x2f\xfd': 'zstd'}
+
+    @classmethod
+    def detect(cls, path: str) -> str:
+        """
+        Returns the compression format of a file, from its magic bytes, or
+        None if it isn't compressed.
+        """
+        with open(path, 'rb') as f:
+            head = f.read(max(map(len, cls.MAGICS)))
+        for magic, fmt in cls.MAGICS.items():
+            if head.startswith(magic):
+                return fmt
+        return None
+
+    def __init__(self, path: str, fmt: str):
+        self.name = path
+        self.format = fmt
+        self.file = open(path, 'rb', buffering=DECOMPRESS_CHUNK_SIZE)
+        if fmt == 'gzip':
+            self.stream = gzip.GzipFile(fileobj=self.file)
+        elif fmt == 'xz':
+            self.stream = lzma.LZMAFile(self.file)
+        elif fmt == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("Reading zstd compressed captures needs the zstandard module")
+            self.stream = zstandard.ZstdDecompressor().stream_reader(self.file, read_across_frames=True)
+        else:
+            raise ValueError("Unknown compression format '{}'".format(fmt))
+
+        self.pos = 0
+        # Lines of the chunk being read
+        self._lines = []
+        self._index = 0
+        self._eof = False
+        self._closed = False
+        self._queue = queue.Queue(DECOMPRESS_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._closed:
+            try:
+                self._queue.put(item, timeout=READER_POLL_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self) -> None:
+        # noinspection PyBroadException
+        try:
+            rest = b''
+            while True:
+                data = self.stream.read(DECOMPRESS_CHUNK_SIZE)
+                if not data:
+                    break
+                # Lines are kept whole within a chunk, unless there's no line ending in it at all
+                end = data.rfind(b"\n") + 1
+                if end:
+                    data, rest = rest + data[:end], data[end:]
+                else:
+                    data, rest = rest + data, b''
+                if not self._put(data):
+                    return
+            self._put(rest)
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def _fill(self) -> bool:
+        """
+        Get the next chunk from the thread if the current one is used up.
+        Returns False at the end.
+        """
+        while self._index >= len(self._lines):
+            if self._eof:
+                return False
+            chunk = self._queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if chunk is None:
+                self._eof = True
+                return False
+            self._lines = chunk.splitlines(True)
+            self._index = 0
+        return True
+
+    def _take(self, size: int) -> bytes:
+        # Up to size bytes of the current line, leaving the rest of it for later
+        line = self._lines[self._index]
+        if 0 <= size < len(line):
+            self._lines[self._index] = line[size:]
+            line = line[:size]
+        else:
+            self._index += 1
+        self.pos += len(line)
+        return line
+
+    def __iter__(self):
+        while self._fill():
+            lines = self._lines
+            while self._index < len(lines) - 1 and lines is self._lines:
+                line = lines[self._index]
+                self._index += 1
+                self.pos += len(line)
+                yield line
+            # The last line of a chunk may carry on in the next ones
+            if lines is self._lines and self._index == len(lines) - 1:
+                yield self.readline()
+
+    def readline(self, size: int = -1) -> bytes:
+        line = b''
+        while self._fill() and (size < 0 or len(line) < size):
+            line += self._take(size - len(line) if size >= 0 else -1)
+            # A line can only be split across chunks that have no line ending
+            if line.endswith(b"\n"):
+                break
+        return line
+
+    def read(self, size: int = -1) -> bytes:
+        data = bytearray()
+        while (size < 0 or len(data) < size) and self._fill():
+            data += self._take(size - len(data) if size >= 0 else -1)
+        return bytes(data)
+
+    def tell(self) -> int:
+        return self.pos
+
+    def close(self) -> None:
+        self._closed = True
+        self._thread.join()
+        self.stream.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FollowInput:
+    """
+    Read-only file object over a capture that is still being written, e.g. by
+    a terminal program logging the console, supporting what CFEParser needs
+    without seeking: line iteration, readline, read and tell.
+
+    At the end of the file, reads wait for it to grow, polling with backoff,
+    and only return what's there once it hasn't grown for `timeout` seconds.
+    Lines are returned whole, except for the prompt, after which CFE waits for
+    the next command.
+    """
+
+    def __init__(self, path: str, timeout: float = FOLLOW_TIMEOUT):
+        self.name = path
+        self.file = open(path, 'rb')
+        self.timeout = timeout
+        # Time spent waiting for the capture to grow
+        self.wait_time = 0.0
+
+    def _wait(self) -> bool:
+        """
+        Wait for the file to grow past the current position. Returns False if
+        it didn't within the timeout.
+        """
+        start = time.monotonic()
+        poll = FOLLOW_POLL_MIN
+        try:
+            while os.fstat(self.file.fileno()).st_size <= self.file.tell():
+                remaining = start + self.timeout - time.monotonic()
+                if remaining <= 0:
+                    return False
+                time.sleep(min(poll, remaining))
+                poll = min(poll * 2, FOLLOW_POLL_MAX)
+            return True
+        finally:
+            self.wait_time += time.monotonic() - start
+
+    def readline(self, size: int = -1) -> bytes:
+        line = self.file.readline(size)
+        while not line.endswith(b"\n") and (size < 0 or len(line) < size):
+            if line.rstrip().endswith(PROMPT) or not self._wait():
+                break
+            line += self.file.readline(size - len(line) if size >= 0 else -1)
+        return line
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        while (size < 0 or len(data) < size) and self._wait():
+            data += self.file.read(size - len(data) if size >= 0 else -1)
+        return data
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 
 class CFEParser(CFEParserBase):
     def __init__(self, input_file: BinaryIO, block_size: int = BLOCK_SIZE, page_size: int = PAGE_SIZE,
-                 nand_size: int = NAND_SIZE, max_retries: int = MAX_RETRIES, printer: PrettyPrinter = None):
-        super().__init__(printer, block_size, page_size, nand_size, max_retries)
+                 nand_size: int = NAND_SIZE, max_retries: int = MAX_RETRIES, printer: PrettyPrinter = None,
+                 sync_mode: str = SYNC_PROMPT, prompt_timeout: float = PROMPT_TIMEOUT, window: int = WINDOW,
+                 oob_size: int = 0, jobs: int = 1, index: CaptureIndex = None):
+        super().__init__(printer, block_size, page_size, nand_size, max_retries, sync_mode, prompt_timeout, window,
+                         oob_size)
         self.input_file = input_file
+        self.jobs = jobs
+        self.index = index
 
     def _read(self, *a, **kw) -> bytes:
         return self.input_file.read(*a, **kw)
@@ -371,44 +2694,687 @@ class CFEParser(CFEParserBase):
         return 0
 
     def _readline(self, *a, **kw) -> bytes:
-        return self.input_file.readline(*a, **kw)
+        # Unlike a port's timeout, an empty read is the end of the capture: the parser would wait for more forever
+        line = self.input_file.readline(*a, **kw)
+        if not line:
+            raise IOError("End of the capture")
+        return line
+
+    def enable_metrics(self, metrics: DumpMetrics) -> None:
+        super().enable_metrics(metrics)
+        self.input_file = MeteredPort(self.input_file, metrics)
 
     def wait_for_prompt(self) -> None:
         pass
 
+    def seek_page(self, block: int, page: int) -> None:
+        """
+        With an index, move to the section of a page in the capture, warning
+        if there is no clean copy of it.
+        """
+        if self.index is None:
+            return
+
+        offset, status = self.index.lookup(block, page)
+        if status:
+            problems = [problem for flag, problem in ((CaptureIndex.ERROR, "read errors reported"),
+                                                      (CaptureIndex.INCOMPLETE, "incomplete")) if status & flag]
+            self.printer.msg("Block {} page {} has no clean copy in the capture ({})"
+                             .format(block, page, ', '.join(problems)))
+        self.input_file.seek(offset)
+
+    def sync_prompt(self) -> None:
+        # With an index every read seeks to its page, no need to look for the prompt
+        if self.index is not None:
+            return
+        # In a capture the prompt shares its line with the next command's echo
+        for line in self.input_file:
+            if PROMPT in line:
+                return
+
     @print_offset_on_exc
-    def parse_pages_bulk(self) -> Generator[bytes, None, None]:
-        return super().parse_pages_bulk()
+    def parse_page_sections(self, number: int = None) -> Generator[Tuple[memoryview, bool, int], None, None]:
+        return super().parse_page_sections(number)
+
+    @print_offset_on_exc_func
+    def read_spare(self, buf: memoryview) -> Tuple[bool, bytes, bool]:
+        return super().read_spare(buf)
 
     @print_offset_on_exc
-    def read_page(self, block: int, page: int) -> bytes:
+    def parse_pages_bulk(self, number: int = None) -> Generator[memoryview, None, None]:
+        if self.jobs > 1:
+            return self.parse_pages_parallel(number)
+        return super().parse_pages_bulk(number)
+
+    def parse_pages_parallel(self, number: int = None) -> Generator[memoryview, None, None]:
+        """
+        Same as parse_pages_bulk, but the rest of the capture is split into
+        slices at page boundaries, which are decoded by `jobs` worker processes.
+        Pages are yielded in the order they appear in the capture, exactly
+        like parse_pages_bulk (not placed by their page numbers). The whole
+        rest of the capture is taken as the output of a single `dn` command.
+        """
+        path = self.input_file.name
+        start = self.input_file.tell()
+        size = os.path.getsize(path)
+        record_size = self.page_size + self.oob_size
+        # Workers print their messages to the same stream
+        out = 'stderr' if self.printer.out is sys.stderr else 'stdout'
+        count = 0
+
+        with open(path, 'rb') as index:
+            executor = ProcessPoolExecutor(self.jobs)
+            pending = deque()
+            try:
+                while start >= 0 or pending:
+                    # Keep a couple of slices per worker queued, so that memory use stays bounded
+                    while start >= 0 and len(pending) < self.jobs * 2:
+                        end = find_section_start(index, start + PARALLEL_CHUNK_SIZE)
+                        pending.append(executor.submit(decode_page_sections, path, start, size if end < 0 else end,
+                                                       self.page_size, self.oob_size, out))
+                        self.input_file.seek(size if end < 0 else end)
+                        start = end
+
+                    data = memoryview(pending.popleft().result())
+                    for offset in range(0, len(data), record_size):
+                        yield data[offset:offset + record_size]
+                        count += 1
+                        if number is not None and count >= number:
+                            return
+            finally:
+                executor.shutdown(cancel_futures=True)
+
+    @print_offset_on_exc_func
+    def read_page(self, block: int, page: int) -> memoryview:
+        self.seek_page(block, page)
         return super().read_page(block, page)
 
+    @print_offset_on_exc_func
+    def read_page_retry(self, block: int, page: int) -> memoryview:
+        return super().read_page_retry(block, page)
+
+    @print_offset_on_exc_func
+    def is_bad_block(self, block: int) -> bool:
+        self.seek_page(block, 0)
+        return super().is_bad_block(block)
+
     @print_offset_on_exc
-    def read_pages(self, block: int, page_start: int, number: int) -> Generator[bytes, None, None]:
-        return super().read_pages(block, page_start, number)
+    def read_pages(self, block: int, page_start: int, number: int,
+                   window: int = None) -> Generator[memoryview, None, None]:
+        return super().read_pages(block, page_start, number, window)
 
     @print_offset_on_exc
-    def read_pages_bulk(self, block: int, page_start: int, number: int) -> Generator[bytes, None, None]:
+    def read_pages_bulk(self, block: int, page_start: int, number: int) -> Generator[memoryview, None, None]:
+        self.seek_page(block, page_start)
         return super().read_pages_bulk(block, page_start, number)
 
     @print_offset_on_exc
-    def read_block(self, block: int) -> Generator[bytes, None, None]:
+    def read_pages_windowed(self, block: int, page_start: int, number: int,
+                            window: int = None) -> Generator[memoryview, None, None]:
+        if self.index is None:
+            yield from super().read_pages_windowed(block, page_start, number, window)
+            return
+
+        # With an index, every window is read from where its first page is in the capture
+        window = window or self.window
+        pages_per_block = self.block_size // self.page_size
+        first = block * pages_per_block + page_start
+        end = first + number
+
+        while first < end:
+            count = min(window, end - first)
+            self.seek_page(first // pages_per_block, first % pages_per_block)
+            yield from super().read_pages_windowed(first // pages_per_block, first % pages_per_block, count, window)
+            first += count
+
+    @print_offset_on_exc
+    def read_block(self, block: int) -> Generator[memoryview, None, None]:
         return super().read_block(block)
 
     @print_offset_on_exc
-    def read_blocks(self, block: int, number: int) -> Generator[bytes, None, None]:
+    def read_blocks(self, block: int, number: int) -> Generator[memoryview, None, None]:
         return super().read_blocks(block, number)
 
     @print_offset_on_exc
-    def read_nand(self) -> Generator[bytes, None, None]:
+    def read_nand(self) -> Generator[memoryview, None, None]:
         return super().read_nand()
 
     @print_offset_on_exc
-    def read_nand_bulk(self) -> Generator[bytes, None, None]:
+    def read_nand_bulk(self) -> Generator[memoryview, None, None]:
         return super().read_nand_bulk()
 
 
+class NandImage(io.RawIOBase):
+    """
+    Read-only file object over the main area of the NAND behind a parser (a
+    device, or a capture indexed with CaptureIndex), reading pages on demand,
+    so that tools can open a live device as if it were an image and only pay
+    for the pages they touch. Also supports slicing like mmap: `image[a:b]`.
+
+    Pages are kept in an LRU cache of up to `cache_size` bytes. The pages of
+    a read that aren't cached are fetched with one `dn` command per run of
+    consecutive pages (up to the cache capacity), verified and re-read one by
+    one if needed like with `-w`.
+
+    The parser is expected to be at the prompt already.
+    """
+
+    def __init__(self, c: CFEParserBase, cache_size: int = NAND_CACHE_SIZE):
+        super().__init__()
+        self.c = c
+        self.page_size = c.page_size
+        self.pages_per_block = c.block_size // c.page_size
+        self.size = c.nand_size
+        self.capacity = max(1, cache_size // self.page_size)
+        self.pos = 0
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+
+    def __len__(self):
+        return self.size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self.pos = offset
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def _fetch(self, first: int, end: int) -> None:
+        """
+        Read the run of pages missing from the cache starting at `first`,
+        up to `end` at most, and cache them.
+        """
+        count = 1
+        while count < self.capacity and first + count < end and first + count not in self.cache:
+            count += 1
+
+        block, page = divmod(first, self.pages_per_block)
+        for i, buf in enumerate(self.c.read_pages(block, page, count, count), first):
+            self.cache[i] = bytes(buf[:self.page_size])
+            if len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+        self.fetches += 1
+        self.misses += count
+
+    def _read_at(self, offset: int, view: memoryview) -> int:
+        size = max(0, min(len(view), self.size - offset))
+        end = (offset + size + self.page_size - 1) // self.page_size
+
+        done = 0
+        while done < size:
+            page, start = divmod(offset + done, self.page_size)
+            data = self.cache.get(page)
+            if data is None:
+                self._fetch(page, end)
+                data = self.cache[page]
+            else:
+                self.cache.move_to_end(page)
+                self.hits += 1
+            count = min(self.page_size - start, size - done)
+            view[done:done + count] = data[start:start + count]
+            done += count
+
+        return size
+
+    def readinto(self, b) -> int:
+        with memoryview(b) as m, m.cast('B') as view:
+            count = self._read_at(self.pos, view)
+        self.pos += count
+        return count
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            indices = range(*item.indices(self.size))
+            if not indices:
+                return b''
+            start, stop = min(indices[0], indices[-1]), max(indices[0], indices[-1]) + 1
+            buf = bytearray(stop - start)
+            self._read_at(start, memoryview(buf))
+            return bytes(buf) if indices.step == 1 else bytes(buf[i - start] for i in indices)
+
+        if item < 0:
+            item += self.size
+        if not 0 <= item < self.size:
+            raise IndexError("NAND index out of range")
+        buf = bytearray(1)
+        self._read_at(item, memoryview(buf))
+        return buf[0]
+
+    def stats(self) -> str:
+        return "{} pages read in {} commands, {} cache hits".format(self.misses, self.fetches, self.hits)
+
+
+def find_section_start(f: BinaryIO, pos: int) -> int:
+    """
+    Find the first page section of a capture starting after `pos`: the
+    offset of its header line, or of the error messages printed right before
+    it, which belong to it. Returns -1 if there is none.
+    """
+    f.seek(pos)
+    # Skip the line pos falls in, then up to a spare area, after which the next page starts
+    f.readline()
+    for line in f:
+        if line.startswith(b"-----") and b'spare area' in line:
+            break
+    else:
+        return -1
+
+    offset = f.tell()
+    section_start = None
+    while True:
+        line = f.readline()
+        if not line:
+            return -1
+        if line.startswith(b"-----"):
+            return offset if section_start is None else section_start
+        if line.strip().startswith(ERROR_LINE_PREFIXES):
+            if section_start is None:
+                section_start = offset
+        elif line.strip():
+            section_start = None
+        offset += len(line)
+
+
+def decode_page_sections(path: str, start: int, end: int, page_size: int, oob_size: int, out: str) -> bytes:
+    """
+    Decode the pages in a slice of a capture, as found by find_section_start.
+    Worker process side of CFEParser.parse_pages_parallel.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    c = CFEParser(io.BytesIO(data), page_size=page_size, printer=PrettyPrinter(getattr(sys, out)),
+                  oob_size=oob_size)
+    return b''.join(c.parse_pages_bulk())
+
+
+def write_erased_map(output: BinaryIO, size: int, runs: List[List[int]], path: str, printer: PrettyPrinter) -> None:
+    # Trailing erased pages must still count in the size of the image
+    if os.fstat(output.fileno()).st_size < size:
+        os.ftruncate(output.fileno(), size)
+
+    with open(path, 'w') as f:
+        json.dump({'fill': 0xff, 'runs': runs}, f)
+
+    printer.msg("\r {} of erased pages left out of the image, listed in {}"
+                .format(format_size(sum(length for _, length in runs)), path))
+
+
+def expand_erased(image: str) -> int:
+    """
+    Fill the erased regions left out of an image (see --erased map) with
+    0xFF, as listed in its map. Returns the number of bytes filled.
+    """
+    with open(image + ".erased") as f:
+        runs = json.load(f)['runs']
+
+    filled = 0
+    chunk = b'\xff' * WRITE_BUFFER_SIZE
+    with open(image, 'r+b') as f:
+        for offset, length in runs:
+            f.seek(offset)
+            for start in range(0, length, len(chunk)):
+                f.write(chunk[:min(len(chunk), length - start)])
+            filled += length
+
+    return filled
+
+
+def get_oob_size(args: argparse.Namespace) -> int:
+    if args.oob or args.oob_file:
+        return args.oob_size or args.page_size // 32
+    return 0
+
+
+def open_device(args: argparse.Namespace, device: str, printer: PrettyPrinter) -> 'CFECommunicator':
+    ser = serial.Serial(device, args.baudrate, timeout=args.timeout)
+    if args.pipeline:
+        ser = PortReader(ser)
+    return CFECommunicator(ser, args.block_size, args.page_size, args.nand_size, args.max_retries, printer,
+                           args.sync, args.prompt_timeout, args.window, get_oob_size(args))
+
+
+def dump(c: CFEParserBase, args: argparse.Namespace, printer: PrettyPrinter) -> None:
+    """
+    Dump the pages requested by args, saving everything received from the
+    console to a capture if requested. The capture is closed (and written out)
+    whatever happens.
+    """
+    capture = None
+    if args.capture:
+        if not isinstance(c, CFECommunicator):
+            raise ValueError("--capture needs a device to capture")
+        capture = CaptureWriter(args.capture)
+        c.enable_capture(capture)
+
+    try:
+        dump_pages(c, args, printer)
+    finally:
+        if capture:
+            capture.close()
+
+    if capture:
+        printer.msg("\r Capture: {}".format(capture.stats()))
+
+
+def dump_pages(c: CFEParserBase, args: argparse.Namespace, printer: PrettyPrinter) -> None:
+    oob_size = get_oob_size(args)
+    # Size of each page in the output image
+    record_size = args.page_size + (oob_size if args.oob else 0)
+
+    pages_per_block = args.block_size // args.page_size
+
+    if args.command == 'page':
+        read, first, pages = c.read_pages, args.block * pages_per_block + args.page, args.number
+    elif args.command == 'pages_bulk':
+        read, first, pages = c.read_pages_bulk, args.block * pages_per_block + args.page, args.number
+    elif args.command == 'block':
+        read, first, pages = c.read_pages, args.block * pages_per_block, pages_per_block * args.number
+    elif args.command == 'nand':
+        read, first, pages = c.read_pages, 0, args.nand_size // args.page_size
+    elif args.command == 'nand_bulk':
+        read, first, pages = c.read_pages_bulk, 0, args.nand_size // args.page_size
+    else:
+        raise RuntimeError
+
+    skip_bad = args.bbt and args.bad_blocks == 'skip'
+
+    if args.store and not args.board_id:
+        raise ValueError("--store needs --board-id to tell boards apart")
+
+    journal = None
+    if args.resume:
+        if skip_bad:
+            raise ValueError("--resume can't be used with --bad-blocks skip")
+        if args.output == '-':
+            raise ValueError("--resume needs an output file")
+        if not isinstance(c, CFECommunicator):
+            raise ValueError("--resume needs a device to read the missing pages from")
+        if args.oob_file:
+            # The journal only records the image, so the spare area file can't be resumed
+            raise ValueError("--resume can't be used with --oob-file, use --oob to keep the spare area in the image")
+        journal = DumpJournal(args.output + ".journal", record_size, first, pages)
+        output = open(args.output, 'r+b' if os.path.exists(args.output) else 'w+b')
+
+        dropped = journal.verify(output)
+        if dropped:
+            printer.msg("{} pages in the journal don't match the image, reading them again".format(dropped))
+        runs = list(journal.missing_runs())
+    else:
+        output = open(args.output, 'wb')
+        runs = [(first, pages)]
+
+    metrics = None
+    if args.metrics:
+        metrics = DumpMetrics(args.metrics, args.metrics_format, args.device or args.input_file)
+        c.enable_metrics(metrics)
+
+    oob_output = None
+    if args.oob_file:
+        oob_output = open(args.oob_file, 'wb')
+
+    pages_read = pages - sum(count for _, count in runs)
+
+    c.wait_for_prompt()
+
+    baudrate = None
+    if args.fast_baudrate and isinstance(c, CFECommunicator):
+        if not args.baud_command:
+            raise ValueError("--fast-baudrate needs --baud-command")
+        baudrate = c.escalate_baudrate([int(b) for b in args.fast_baudrate.split(',')], args.baud_command)
+
+    if args.bbt:
+        if os.path.exists(args.bbt):
+            with open(args.bbt) as f:
+                c.bad_blocks = set(json.load(f)['bad_blocks'])
+        elif isinstance(c, CFECommunicator):
+            c.bad_blocks = set(c.scan_bad_blocks())
+            with open(args.bbt, 'w') as f:
+                json.dump({'nand_size': args.nand_size, 'block_size': args.block_size,
+                           'bad_blocks': sorted(c.bad_blocks)}, f, indent=2)
+        else:
+            raise ValueError("Bad block table {} doesn't exist".format(args.bbt))
+
+    store = None
+    if args.store:
+        if not isinstance(c, CFECommunicator):
+            raise ValueError("--store needs a device to read pages from")
+        store = PageStore(args.store, args.board_id, args.page_size, oob_size, pages_per_block, args.store_size)
+        c.enable_store(store)
+
+    if args.preallocate and skip_bad:
+        raise ValueError("--preallocate can't be used with --bad-blocks skip")
+
+    # Runs of erased pages left out of the output, as [offset, length]
+    erased_runs = None
+    if args.erased == 'map':
+        if journal:
+            raise ValueError("--erased map can't be used with --resume")
+        if args.preallocate:
+            raise ValueError("--erased map can't be used with --preallocate")
+        erased_runs = []
+        erased = b'\xff' * (args.page_size + (oob_size if args.oob else 0))
+
+    # A single thread writes all the files, in order
+    executor = ThreadPoolExecutor(max_workers=1)
+    writers = [OutputWriter(output, executor, args.write_buffer, args.direct)]
+    if oob_output:
+        writers.append(OutputWriter(oob_output, executor, args.write_buffer, args.direct))
+    if args.preallocate:
+        writers[0].preallocate(pages * record_size)
+        if oob_output:
+            writers[1].preallocate(pages * oob_size)
+    out_writer, oob_writer = writers[0], writers[1] if oob_output else None
+
+    # Pages written since the last checkpoint, marked as done in the journal once they're durable
+    marks = []
+    last_checkpoint = time.monotonic()
+
+    def checkpoint() -> None:
+        nonlocal marks, last_checkpoint
+        for writer in writers:
+            writer.sync()
+        if journal and marks:
+            executor.submit(journal.checkpoint, marks)
+            marks = []
+        last_checkpoint = time.monotonic()
+
+    with output:
+        try:
+            for start, count in runs:
+                if journal:
+                    out_writer.seek((start - first) * record_size)
+                    if oob_writer:
+                        oob_writer.seek((start - first) * oob_size)
+
+                for i, page in enumerate(read(start // pages_per_block, start % pages_per_block, count), start):
+                    pages_read += 1
+                    if metrics:
+                        metrics.page(i, pages_per_block)
+                    if skip_bad and i // pages_per_block in c.bad_blocks:
+                        continue
+                    if oob_writer:
+                        oob_writer.write(page[args.page_size:])
+                        page = page[:args.page_size]
+                    if erased_runs is not None and page.tobytes() == erased:
+                        # Left as a hole, recorded in the map
+                        offset = out_writer.tell()
+                        if erased_runs and sum(erased_runs[-1]) == offset:
+                            erased_runs[-1][1] += len(page)
+                        else:
+                            erased_runs.append([offset, len(page)])
+                        out_writer.seek(offset + len(page))
+                    else:
+                        out_writer.write(page)
+                    if journal:
+                        marks.append((i, zlib.crc32(page)))
+                    printer.print_progress(pages_read, pages)
+                    if out_writer.pending >= args.checkpoint_size or \
+                            time.monotonic() - last_checkpoint >= args.checkpoint_interval:
+                        checkpoint()
+        except Exception:
+            printer.print_progress(pages_read, pages, force=True)
+            raise
+        finally:
+            try:
+                checkpoint()
+                for writer in writers:
+                    writer.close()
+                executor.shutdown()
+                if erased_runs is not None:
+                    write_erased_map(output, out_writer.tell(), erased_runs, args.output + ".erased", printer)
+            finally:
+                if journal:
+                    journal.close()
+                if metrics:
+                    metrics.close()
+                if store:
+                    store.close()
+                if oob_output:
+                    oob_output.close()
+                if baudrate and baudrate != int(args.baudrate):
+                    c.set_baudrate(int(args.baudrate), args.baud_command)
+
+    if args.pipeline and isinstance(c, CFECommunicator):
+        printer.msg("\r Pipeline: {}; writer waited {:.1f}s"
+                    .format(c.ser.stats(), sum(w.wait_time for w in writers)))
+
+    if store:
+        printer.msg("\r Page store: {}".format(store.stats()))
+    if args.follow and isinstance(c, CFEParser):
+        printer.msg("\r Waited {:.1f}s for the input file to grow".format(c.input_file.wait_time))
+
+    printer.print("\n\n")
+
+
+def dump_multi(args: argparse.Namespace) -> bool:
+    """
+    Dump the whole NAND of several devices concurrently, one thread each,
+    rendering a single progress table. Returns whether all dumps succeeded.
+    """
+    devices = []
+    for pattern in args.devices:
+        devices += sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+    if not devices:
+        raise ValueError("No devices found")
+
+    if args.output == '-':
+        args.output = "{name}.img"
+    elif '{name}' not in args.output:
+        raise ValueError("With multi, the output must contain '{name}', which is replaced by each device's name")
+    if args.store:
+        # A device name says which port a board is on, not which board it is, so it can't name it in the store
+        raise ValueError("--store can't be used with multi, which has no way to tell each board apart")
+
+    table = MultiProgressPrinter(sys.stderr, args.page_size, "pages")
+    progress = [DeviceProgress(os.path.basename(device)) for device in devices]
+
+    def run(device: str, printer: 'DeviceProgress') -> bool:
+        name = printer.name
+        device_args = argparse.Namespace(**vars(args))
+        device_args.command = 'nand'
+        device_args.device = device
+        for option in ('output', 'oob_file', 'bbt', 'metrics', 'capture'):
+            if getattr(args, option):
+                setattr(device_args, option, getattr(args, option).format(name=name))
+
+        # noinspection PyBroadException
+        try:
+            c = open_device(device_args, device, printer)
+            with c.ser:
+                dump(c, device_args, printer)
+            printer.finished = True
+            printer.status = "done"
+            return True
+        except Exception as e:
+            printer.finished = True
+            printer.status = "failed: {}".format(e)
+            return False
+
+    if args.asyncio:
+        # Pages are written as they're read, one at a time: none of the other ways of reading or writing them apply
+        for option in ('resume', 'bbt', 'fast_baudrate', 'oob_file', 'metrics', 'capture', 'pipeline', 'direct',
+                       'preallocate'):
+            if getattr(args, option):
+                raise ValueError("--{} can't be used with --asyncio".format(option.replace('_', '-')))
+        for option, default in (('window', WINDOW), ('erased', 'write'), ('bad_blocks', 'fill')):
+            if getattr(args, option) != default:
+                raise ValueError("--{} can't be used with --asyncio".format(option.replace('_', '-')))
+        return asyncio.run(dump_multi_async(args, devices, progress, table))
+
+    with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+        futures = [executor.submit(run, device, printer) for device, printer in zip(devices, progress)]
+        while not all(f.done() for f in futures):
+            table.render(progress)
+            time.sleep(MULTI_REFRESH_INTERVAL)
+        table.render(progress)
+
+    return all(f.result() for f in futures)
+
+
+async def dump_nand_async(args: argparse.Namespace, device: str, printer: DeviceProgress) -> bool:
+    pages = args.nand_size // args.page_size
+
+    # noinspection PyBroadException
+    try:
+        with serial.Serial(device, args.baudrate, timeout=0) as ser, \
+                open(args.output.format(name=printer.name), 'wb') as output:
+            transport = AsyncSerialTransport(ser)
+            try:
+                c = AsyncCFECommunicator(transport, args.block_size, args.page_size, args.nand_size,
+                                         args.max_retries, printer, args.sync, args.prompt_timeout,
+                                         get_oob_size(args), args.timeout)
+                await c.wait_for_prompt()
+
+                done = 0
+                async for page in c.read_nand():
+                    output.write(page)
+                    done += 1
+                    printer.print_progress(done, pages)
+            finally:
+                transport.close()
+
+        printer.finished = True
+        printer.status = "done"
+        return True
+    except Exception as e:
+        printer.finished = True
+        printer.status = "failed: {}".format(e)
+        return False
+
+
+async def dump_multi_async(args: argparse.Namespace, devices: List[str], progress: List[DeviceProgress],
+                           table: 'MultiProgressPrinter') -> bool:
+    """
+    Same as the threaded multi dump, but drives all the ports from one event loop.
+    """
+    tasks = [asyncio.ensure_future(dump_nand_async(args, device, printer))
+             for device, printer in zip(devices, progress)]
+
+    while not all(t.done() for t in tasks):
+        table.render(progress)
+        await asyncio.wait(tasks, timeout=MULTI_REFRESH_INTERVAL)
+    table.render(progress)
+
+    return all(t.result() for t in tasks)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Broadcom CFE dumper")
     parser.add_argument('-N', '--nand-size', type=int, help="NAND size", default=NAND_SIZE)
@@ -418,10 +3384,83 @@ def main():
     parser.add_argument('-t', '--timeout', type=float, help="Serial port timeout", default=0.1)
     parser.add_argument('-O', '--output', type=str, help="Output file, '-' for stdout", default='-')
     parser.add_argument('-r', '--max-retries', type=int, help="Max retries per page on failure", default=MAX_RETRIES)
+    parser.add_argument('-s', '--sync', type=str, choices=SYNC_MODES, default=SYNC_PROMPT,
+                        help="How to wait for CFE after each page: read up to the prompt, or drain input until "
+                             "the serial timeout expires")
+    parser.add_argument('--prompt-timeout', type=float, default=PROMPT_TIMEOUT,
+                        help="Max seconds to wait for the prompt before draining input")
+    parser.add_argument('-w', '--window', type=int, default=WINDOW,
+                        help="Pages requested per dn command by page/block/nand; failed pages are re-read one by one")
+
+    parser.add_argument('-F', '--fast-baudrate', type=str,
+                        help="Comma separated baud rates to try switching to before dumping, fastest first")
+    parser.add_argument('--baud-command', type=str,
+                        help="CFE command that changes the console baud rate, '{baudrate}' is replaced with the rate")
+    parser.add_argument('--oob', action='store_true',
+                        help="Also dump the spare area, appending it to each page in the output (like nanddump)")
+    parser.add_argument('--oob-file', type=str, help="Also dump the spare area, writing it to this file")
+    parser.add_argument('--oob-size', type=int, help="Spare area size per page (default: page size / 32)")
+    parser.add_argument('--bbt', type=str,
+                        help="Bad block table (JSON). If the file doesn't exist, the device is scanned for bad blocks "
+                             "first and the table is saved to it")
+    parser.add_argument('--bad-blocks', type=str, choices=('fill', 'skip'), default='fill',
+                        help="What page/block/nand do with bad blocks in the table: fill them with 0xFF (with a bad "
+                             "block marker in the spare area) or leave them out of the output")
+    parser.add_argument('--erased', type=str, choices=('write', 'map'), default='write',
+                        help="What to do with erased pages (all 0xFF): write them like any other, or leave them out "
+                             "of the image as holes, listing them in OUTPUT.erased (see the expand command)")
+    parser.add_argument('-p', '--pipeline', action='store_true',
+                        help="Read the serial port from a dedicated thread into a {} buffer, so that it's drained "
+                             "continuously while pages are parsed and written"
+                             .format(format_size(PIPELINE_BUFFER_SIZE)))
+    parser.add_argument('--write-buffer', type=int, default=WRITE_BUFFER_SIZE,
+                        help="Output buffer size; buffers are written out in the background")
+    parser.add_argument('--checkpoint-size', type=int, default=CHECKPOINT_SIZE,
+                        help="Sync the output (and the journal with -R) to disk every time this many bytes are "
+                             "written...")
+    parser.add_argument('--checkpoint-interval', type=float, default=CHECKPOINT_INTERVAL,
+                        help="...or every this many seconds")
+    parser.add_argument('--direct', action='store_true',
+                        help="Write the output with O_DIRECT, bypassing the page cache")
+    parser.add_argument('--preallocate', action='store_true',
+                        help="Allocate the whole output file before dumping")
+    parser.add_argument('--metrics', type=str,
+                        help="Record per page timings (command sent, first byte, end of data, prompt), bytes on the "
+                             "wire, retries and error messages to this file")
+    parser.add_argument('--metrics-format', type=str, choices=DumpMetrics.FORMATS, default='jsonl',
+                        help="Metrics file format: a JSON line per page, or a Prometheus textfile with the totals")
+    parser.add_argument('-C', '--capture', type=str,
+                        help="Save everything received from the console to this file, compressed in the background "
+                             "if it ends in .gz, .xz or .zst (needs zstandard), to decode it again later with -i")
+    parser.add_argument('-S', '--store', type=str,
+                        help="Directory of the persistent page store: pages already read from the board are taken "
+                             "from it, and the ones read are added to it")
+    parser.add_argument('--store-size', type=int, default=PAGE_STORE_SIZE,
+                        help="Disk space used by the page store, beyond which the least recently used blocks are "
+                             "evicted")
+    parser.add_argument('--board-id', type=str,
+                        help="Name of the board in the page store, which has to be unique to it (e.g. its serial "
+                             "number or MAC address); needed with --store")
+    parser.add_argument('-R', '--resume', action='store_true',
+                        help="Keep track of the pages written in a journal next to the output file, and only read "
+                             "the missing ones if it already exists")
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-D', '--device', type=str, help="Serial port")
-    group.add_argument('-i', '--input-file', type=str, help="Input file")
+    group.add_argument('-i', '--input-file', type=str,
+                       help="Input file, a capture of the console (possibly compressed with gzip, xz or zstd)")
+    parser.add_argument('-M', '--mmap', action='store_true', help="Memory map the input file instead of reading it")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Processes decoding the input file in parallel (pages_bulk and nand_bulk only)")
+    parser.add_argument('-I', '--index', action='store_true',
+                        help="Index the page sections of the input file in a sidecar file (INPUT.idx, built on first "
+                             "use), and seek straight to the pages requested")
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help="Decode the input file as it's being written (e.g. by a terminal program logging the "
+                             "console), waiting for it to grow")
+    parser.add_argument('--follow-timeout', type=float, default=FOLLOW_TIMEOUT,
+                        help="With --follow, consider the input file complete once it hasn't grown for this many "
+                             "seconds")
 
     subparsers = parser.add_subparsers(help="Available commands", dest='command')
 
@@ -445,55 +3484,51 @@ def main():
     subparsers.add_parser('nand', help="Read the entire NAND")
     subparsers.add_parser('nand_bulk', help="Read the entire NAND in bulk")
 
+    multi_parser = subparsers.add_parser('multi', help="Read the entire NAND of several devices at once")
+    multi_parser.add_argument('devices', type=str, nargs='+', help="Serial ports, or glob patterns matching them")
+    multi_parser.add_argument('-a', '--asyncio', action='store_true',
+                              help="Drive all the ports from a single asyncio event loop instead of one thread each "
+                                   "(page by page reads only)")
+
+    expand_parser = subparsers.add_parser('expand', help="Fill the erased pages left out of an image with 0xFF")
+    expand_parser.add_argument('image', type=str, help="Image dumped with --erased map")
+
     args = parser.parse_args()
+
+    if args.command == 'expand':
+        print("Filled {} of erased pages".format(format_size(expand_erased(args.image))))
+        return
+
+    if args.command == 'multi':
+        if not dump_multi(args):
+            sys.exit(1)
+        return
+
     printer = ProgressPrinter(sys.stdout if args.output != "-" else sys.stderr, args.page_size, "pages")
 
     if getattr(args, "device", None):
-        ser = serial.Serial(args.device, args.baudrate, timeout=args.timeout)
-        c = CFECommunicator(ser, args.block_size, args.page_size, args.nand_size, args.max_retries, printer)
+        c = open_device(args, args.device, printer)
     elif getattr(args, "input_file", None):
-        ser = open(args.input_file, 'rb')
-        c = CFEParser(ser, args.block_size, args.page_size, args.nand_size, args.max_retries, printer)
+        compression = CompressedInput.detect(args.input_file)
+        if args.follow:
+            if compression or args.mmap or args.index or args.jobs > 1:
+                raise ValueError("--follow can't be used with -M, -I, -j or a compressed input file")
+            ser = FollowInput(args.input_file, args.follow_timeout)
+        elif compression:
+            if args.mmap or args.index or args.jobs > 1:
+                raise ValueError("-M, -I and -j need an uncompressed input file")
+            ser = CompressedInput(args.input_file, compression)
+        else:
+            ser = MappedInput(args.input_file) if args.mmap else open(args.input_file, 'rb')
+        index = None
+        if args.index:
+            index = CaptureIndex(args.input_file, args.page_size, args.block_size // args.page_size, printer)
+        c = CFEParser(ser, args.block_size, args.page_size, args.nand_size, args.max_retries, printer,
+                      args.sync, args.prompt_timeout, args.window, get_oob_size(args), args.jobs, index)
     else:
         raise ValueError("Please provide an input")
 
-    if args.command == 'page':
-        gen = c.read_pages(args.block, args.page, args.number)
-        pages = args.number
-    elif args.command == 'pages_bulk':
-        gen = c.read_pages_bulk(args.block, args.page, args.number)
-        pages = args.number
-    elif args.command == 'block':
-        gen = c.read_blocks(args.block, args.number)
-        pages = args.block_size // args.page_size * args.number
-    elif args.command == 'nand':
-        gen = c.read_nand()
-        pages = args.nand_size // args.page_size
-    elif args.command == 'nand_bulk':
-        gen = c.read_nand_bulk()
-        pages = args.nand_size // args.page_size
-    else:
-        raise RuntimeError
-
-    pages_read = 0
-
-    c.wait_for_prompt()
-
-    with open(args.output, 'wb') as output:
-        try:
-            for page in gen:
-                pages_read += 1
-                output.write(page)
-                if type(c) == CFECommunicator or pages_read % 200 == 0:
-                    printer.print_progress(pages_read, pages)
-                    output.flush()
-        except Exception:
-            printer.print_progress(pages_read, pages)
-            output.flush()
-            raise
-        output.flush()
-
-    printer.print("\n\n")
+    dump(c, args, printer)
 
 
 if __name__ == "__main__":
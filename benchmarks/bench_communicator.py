@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Measure CFECommunicator throughput against the simulated CFE console, for
+the page, block, nand and nand_bulk read modes.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bcm_cfedump import CFECommunicator, PortReader, PrettyPrinter, SYNC_MODES, SYNC_PROMPT, format_size, PAGE_SIZE, \
+    BLOCK_SIZE  # noqa: E402
+from cfe_simulator import CFESimulator, SimulatedSerial  # noqa: E402
+
+MODES = ('page', 'block', 'nand', 'nand_bulk')
+
+
+def run_mode(c: CFECommunicator, mode: str, pages: int) -> list:
+    pages_per_block = c.block_size // c.page_size
+
+    if mode == 'page':
+        gen = c.read_pages(0, 0, pages)
+    elif mode == 'block':
+        gen = c.read_blocks(0, max(1, pages // pages_per_block))
+    elif mode == 'nand':
+        gen = c.read_nand()
+    elif mode == 'nand_bulk':
+        gen = c.read_nand_bulk()
+    else:
+        raise ValueError(mode)
+
+    return [bytes(page) for page in gen]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CFECommunicator benchmark against a simulated CFE")
+    parser.add_argument('-N', '--nand-size', type=int, default=1024 * 1024, help="Simulated NAND size")
+    parser.add_argument('-n', '--pages', type=int, default=64, help="Pages read by the page and block modes")
+    parser.add_argument('-b', '--baudrate', type=int, default=3000000, help="Simulated baud rate")
+    parser.add_argument('-t', '--timeout', type=float, default=0.1, help="Serial port timeout")
+    parser.add_argument('-s', '--sync', type=str, choices=SYNC_MODES, default=SYNC_PROMPT)
+    parser.add_argument('-w', '--window', type=int, default=1)
+    parser.add_argument('-p', '--pipeline', action='store_true', help="Read the port from a dedicated thread")
+    parser.add_argument('--ecc-rate', type=float, default=0, help="Probability of an ECC error message per page")
+    parser.add_argument('--drop-rate', type=float, default=0, help="Probability of dropping each line")
+    parser.add_argument('--garble-rate', type=float, default=0, help="Probability of garbling each line")
+    parser.add_argument('--prompt-latency', type=float, default=0, help="Delay before each prompt, in seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-m', '--modes', type=str, default=','.join(MODES),
+                        help="Comma separated modes to run, among {}".format(', '.join(MODES)))
+    args = parser.parse_args()
+
+    image = os.urandom(args.nand_size)
+    printer = PrettyPrinter(open(os.devnull, 'w'))
+
+    print("{:<10} {:>7} {:>9} {:>9} {:>10} {:>10}"
+          .format("mode", "pages", "wall (s)", "pages/s", "data/s", "bad pages"))
+
+    for mode in args.modes.split(','):
+        sim = CFESimulator(image, BLOCK_SIZE, PAGE_SIZE, ecc_rate=args.ecc_rate, drop_rate=args.drop_rate,
+                           garble_rate=args.garble_rate, prompt_latency=args.prompt_latency, seed=args.seed)
+        ser = SimulatedSerial(sim, args.baudrate, args.timeout)
+        if args.pipeline:
+            ser = PortReader(ser)
+        c = CFECommunicator(ser, BLOCK_SIZE, PAGE_SIZE, args.nand_size, printer=printer, sync_mode=args.sync,
+                            window=args.window)
+        c.wait_for_prompt()
+
+        start = time.time()
+        try:
+            pages = run_mode(c, mode, args.pages)
+        except IOError as e:
+            print("{:<10} failed: {}".format(mode, e))
+            continue
+        wall = time.time() - start
+
+        bad = sum(page != image[i * PAGE_SIZE:(i + 1) * PAGE_SIZE] for i, page in enumerate(pages))
+        print("{:<10} {:>7} {:>9.2f} {:>9.1f} {:>8}/s {:>10}".format(
+            mode, len(pages), wall, len(pages) / wall, format_size(len(pages) * PAGE_SIZE / wall), bad))
+        if args.pipeline:
+            print("{:<10} {}".format('', ser.stats()))
+            ser.close()
+
+
+if __name__ == "__main__":
+    main()
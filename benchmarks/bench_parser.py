@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Measure CFEParser throughput on synthetic `dn` captures.
+
+Each run happens in a child process, so that the peak RSS reported is the
+run's own. Release builds of CPython don't count allocations, so the memory
+held by Python objects is reported instead: the peak traced by tracemalloc
+over a separate pass on the first TRACED_PAGES pages. A parser that keeps
+memory bounded shows the same figure whatever the capture size.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bcm_cfedump import CFEParser, PrettyPrinter, format_size, PAGE_SIZE, BLOCK_SIZE  # noqa: E402
+from cfe_simulator import CFESimulator, OOB_SIZE  # noqa: E402
+
+MODES = ('nand_bulk', 'nand', 'block')
+# Modes reading a capture of one dn command per page; the others read a single bulk dn
+PAGE_MODES = ('nand', 'block')
+TRACED_PAGES = 256
+
+
+class SyntheticImage:
+    """
+    Deterministic pseudo-random NAND contents, generated a page at a time so
+    that large images don't have to fit in memory.
+    """
+
+    def __init__(self, size: int, seed: int = 0):
+        self.size = size
+        self.seed = seed
+
+    def __len__(self):
+        return self.size
+
+    def page(self, page: int) -> bytes:
+        return random.Random(self.seed * 1000003 + page).randbytes(PAGE_SIZE)
+
+    def __getitem__(self, item: slice) -> bytes:
+        start, stop, _ = item.indices(self.size)
+        data = b''.join(self.page(p) for p in range(start // PAGE_SIZE, (stop + PAGE_SIZE - 1) // PAGE_SIZE))
+        offset = start - start // PAGE_SIZE * PAGE_SIZE
+        return data[offset:offset + stop - start]
+
+
+def parse_size(size: str) -> int:
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if size[-1].upper() in units:
+        return int(size[:-1]) * units[size[-1].upper()]
+    return int(size)
+
+
+def write_capture(path: str, sim: CFESimulator, per_page: bool) -> None:
+    pages_per_block = sim.block_size // sim.page_size
+
+    if per_page:
+        commands = ("dn {} {} 1".format(*divmod(page, pages_per_block)) for page in range(sim.pages))
+    else:
+        commands = ("dn 0 0 {}".format(sim.pages),)
+
+    with open(path, 'wb') as f:
+        f.write(b"CFE> ")
+        for command in commands:
+            f.write(command.encode() + b"\r\n")
+            for chunk in sim.execute(command.encode()):
+                if isinstance(chunk, bytes):
+                    f.write(chunk)
+
+
+def read_capture(capture: str, mode: str, nand_size: int, oob_size: int, limit: int = None) -> int:
+    with open(capture, 'rb') as f:
+        c = CFEParser(f, BLOCK_SIZE, PAGE_SIZE, nand_size, printer=PrettyPrinter(open(os.devnull, 'w')),
+                      oob_size=oob_size)
+
+        if mode == 'nand_bulk':
+            gen = c.read_nand_bulk()
+        elif mode == 'nand':
+            gen = c.read_nand()
+        elif mode == 'block':
+            gen = c.read_blocks(0, nand_size // BLOCK_SIZE)
+        else:
+            raise ValueError(mode)
+
+        pages = 0
+        for _ in gen:
+            pages += 1
+            if pages == limit:
+                break
+
+        return pages
+
+
+def run(capture: str, mode: str, nand_size: int, oob_size: int, results: multiprocessing.Queue) -> None:
+    # noinspection PyBroadException
+    try:
+        start = time.time()
+        pages = read_capture(capture, mode, nand_size, oob_size)
+        wall = time.time() - start
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+        tracemalloc.start()
+        read_capture(capture, mode, nand_size, oob_size, TRACED_PAGES)
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    except Exception as e:
+        results.put(("failed: {}".format(e),))
+        return
+
+    results.put((pages, wall, peak_rss, traced_peak))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CFEParser benchmark on synthetic captures")
+    parser.add_argument('-S', '--sizes', type=str, default="1M,16M",
+                        help="Comma separated NAND sizes to generate captures for (K/M/G suffixes allowed)")
+    parser.add_argument('-m', '--modes', type=str, default=','.join(MODES),
+                        help="Comma separated modes to run, among {}".format(', '.join(MODES)))
+    parser.add_argument('--ecc-rate', type=float, default=0.01,
+                        help="Probability of an ECC error message per page, in the 'errors' captures")
+    parser.add_argument('--drop-rate', type=float, default=0.001,
+                        help="Probability of a missing line, in the 'errors' captures (bulk only: page by page "
+                             "captures would need the retries of a live session)")
+    parser.add_argument('-d', '--directory', type=str, default=None, help="Where to write the captures")
+    parser.add_argument('--keep', action='store_true', help="Keep the generated captures")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('fork')
+    directory = args.directory or tempfile.mkdtemp(prefix="cfedump-bench-")
+
+    print("{:<6} {:<10} {:<7} {:<4} {:>8} {:>9} {:>10} {:>10} {:>10} {:>12}".format(
+        "size", "mode", "capture", "oob", "pages", "wall (s)", "input/s", "output/s", "peak RSS", "traced peak"))
+
+    for size_str in args.sizes.split(','):
+        size = parse_size(size_str)
+        image = SyntheticImage(size)
+
+        for variant in ('clean', 'errors'):
+            captures = {}
+
+            for mode in args.modes.split(','):
+                per_page = mode in PAGE_MODES
+                if per_page not in captures:
+                    errors = variant == 'errors'
+                    sim = CFESimulator(image, BLOCK_SIZE, PAGE_SIZE, oob_size=OOB_SIZE,
+                                       ecc_rate=args.ecc_rate if errors else 0,
+                                       drop_rate=args.drop_rate if errors and not per_page else 0)
+                    path = os.path.join(directory, "{}-{}-{}.log".format(size_str, variant,
+                                                                         'pages' if per_page else 'bulk'))
+                    write_capture(path, sim, per_page)
+                    captures[per_page] = path
+                capture = captures[per_page]
+                capture_size = os.path.getsize(capture)
+
+                for oob_size in (0, OOB_SIZE):
+                    results = ctx.Queue()
+                    p = ctx.Process(target=run, args=(capture, mode, size, oob_size, results))
+                    p.start()
+                    result = results.get()
+                    p.join()
+
+                    prefix = "{:<6} {:<10} {:<7} {:<4}".format(size_str, mode, variant, 'yes' if oob_size else 'no')
+                    if len(result) == 1:
+                        print(prefix, result[0])
+                        continue
+
+                    pages, wall, peak_rss, traced = result
+                    print(prefix, "{:>8} {:>9.2f} {:>8}/s {:>8}/s {:>10} {:>12}".format(
+                        pages, wall, format_size(capture_size / wall), format_size(pages * PAGE_SIZE / wall),
+                        format_size(peak_rss), format_size(traced)))
+
+            if not args.keep:
+                for path in captures.values():
+                    os.remove(path)
+
+    if not args.keep and not args.directory:
+        os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
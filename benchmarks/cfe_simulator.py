@@ -0,0 +1,312 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Simulated CFE console serving a NAND image through the `dn` command, for
+benchmarking bcm_cfedump without a board.
+
+SimulatedSerial implements the subset of serial.Serial used by
+CFECommunicator, pacing its output at the configured baud rate (10 bits per
+byte) and honouring read timeouts the way a real port does. PtyServer exposes
+the same simulation on a pseudo-terminal, for code that needs a real file
+descriptor.
+"""
+import os
+import random
+import re
+import select
+import threading
+import time
+import tty
+from collections import deque
+from typing import Generator, Optional, Union
+
+PAGE_SIZE = 2048
+OOB_SIZE = 64
+BLOCK_SIZE = 128 * 1024
+# Data is handed over at most this often, like the latency timer of USB serial adapters
+POLL_INTERVAL = 0.001
+
+dn_regex = re.compile(rb'dn\s+(\d+)\s+(\d+)(?:\s+(\d+))?')
+baud_regex = re.compile(rb'setbaud\s+(\d+)')
+
+
+def format_line(addr: int, data: bytes) -> bytes:
+    ascii_col = ''.join(chr(c) if 32 <= c < 127 else '.' for c in data)
+    groups = ' '.join(data[i:i + 4].hex() for i in range(0, 16, 4))
+    return "{:08x}: {}    {}\r\n".format(addr, groups, ascii_col).encode()
+
+
+class CFESimulator:
+    """
+    Produces the console output of CFE commands for a NAND image, optionally
+    injecting ECC error messages, dropped and garbled lines, and a delay before
+    each prompt.
+    """
+
+    def __init__(self, image: bytes, block_size: int = BLOCK_SIZE, page_size: int = PAGE_SIZE,
+                 oob: bytes = None, oob_size: int = OOB_SIZE, ecc_rate: float = 0, drop_rate: float = 0,
+                 garble_rate: float = 0, prompt_latency: float = 0, seed: int = 0):
+        self.image = image
+        self.block_size = block_size
+        self.page_size = page_size
+        self.oob = oob
+        self.oob_size = oob_size
+        self.ecc_rate = ecc_rate
+        self.drop_rate = drop_rate
+        self.garble_rate = garble_rate
+        self.prompt_latency = prompt_latency
+        self.random = random.Random(seed)
+        self.baudrate = None
+
+    @property
+    def pages(self) -> int:
+        return len(self.image) // self.page_size
+
+    def prompt(self) -> Generator[Union[bytes, float], None, None]:
+        if self.prompt_latency:
+            yield self.prompt_latency
+        yield b"CFE> "
+
+    def data_lines(self, base: int, data: bytes) -> Generator[bytes, None, None]:
+        for offset in range(0, len(data), 16):
+            if self.drop_rate and self.random.random() < self.drop_rate:
+                continue
+
+            line = format_line(base + offset, data[offset:offset + 16])
+            if self.garble_rate and self.random.random() < self.garble_rate:
+                i = self.random.randrange(len(line) - 2)
+                line = line[:i] + bytes([self.random.randrange(32, 127)]) + line[i + 1:]
+            yield line
+
+    def dump_page(self, page: int) -> Generator[bytes, None, None]:
+        pages_per_block = self.block_size // self.page_size
+        block, page_in_block = divmod(page, pages_per_block)
+
+        if self.ecc_rate and self.random.random() < self.ecc_rate:
+            yield "Uncorrectable ECC Error detected at block {}, page {}\r\n".format(block, page_in_block).encode()
+
+        yield "------------------ block: {}, page: {} ------------------\r\n".format(block, page_in_block).encode()
+        base = page * self.page_size
+        yield b''.join(self.data_lines(base, self.image[base:base + self.page_size]))
+
+        yield "------------- spare area for block {}, page {} -------------\r\n" \
+            .format(block, page_in_block).encode()
+        if self.oob is not None:
+            oob = self.oob[page * self.oob_size:(page + 1) * self.oob_size]
+        else:
+            oob = b'\xff' * self.oob_size
+        yield b''.join(self.data_lines(0, oob))
+
+    def execute(self, command: bytes) -> Generator[Union[bytes, float], None, None]:
+        """
+        Yield the output of a command line as chunks of bytes, or floats for
+        pauses in seconds.
+        """
+        command = command.strip()
+
+        m = dn_regex.fullmatch(command)
+        if m:
+            block, page, number = int(m.group(1)), int(m.group(2)), int(m.group(3) or 1)
+            first = block * (self.block_size // self.page_size) + page
+            for i in range(first, min(first + number, self.pages)):
+                yield from self.dump_page(i)
+            yield b"\r\n"
+        elif baud_regex.fullmatch(command):
+            self.baudrate = int(baud_regex.fullmatch(command).group(1))
+        elif command:
+            yield b"Invalid command: " + command.split()[0] + b"\r\n"
+
+        yield from self.prompt()
+
+
+class SimulatedSerial:
+    """
+    In-process stand-in for serial.Serial connected to a CFESimulator.
+
+    Output becomes readable at the pace of the baud rate; commands are
+    executed when a line ending is written, and echoed back like a terminal.
+    """
+
+    def __init__(self, simulator: CFESimulator, baudrate: int = 115200, timeout: Optional[float] = 0.1):
+        self.sim = simulator
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.bytes_sent = 0
+        self._input = b''
+        self._output = deque()
+        # Segments of scheduled output: [time the first byte is ready, data, bytes consumed]
+        self._segments = deque()
+        self._line_free = time.monotonic()
+        # Signalled when a command is written, for reads waiting in another thread
+        self._written = threading.Condition()
+
+    @property
+    def byte_time(self) -> float:
+        return 10 / self.baudrate
+
+    def _schedule(self) -> bool:
+        """
+        Schedule the next chunk of pending output; returns False if there is none.
+        """
+        pause = 0
+        while self._output:
+            try:
+                chunk = next(self._output[0])
+            except StopIteration:
+                self._output.popleft()
+                continue
+
+            if isinstance(chunk, float):
+                pause += chunk
+                continue
+
+            start = max(self._line_free, time.monotonic()) + pause
+            self._segments.append([start, chunk, 0])
+            self._line_free = start + len(chunk) * self.byte_time
+            return True
+
+        return False
+
+    def _ready(self, segment: list, now: float) -> int:
+        # Byte k is ready once k + 1 bytes have gone through the line
+        start, data, consumed = segment
+        return min(len(data), int((now - start) / self.byte_time)) - consumed
+
+    def read_until(self, expected: bytes = b'\n', size: Optional[int] = None) -> bytes:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        result = bytearray()
+
+        while size is None or len(result) < size:
+            if not self._segments and not self._schedule():
+                # Nothing else will arrive unless a command is written in the meantime
+                if deadline is None:
+                    break
+                with self._written:
+                    remaining = deadline - time.monotonic()
+                    if remaining > 0 and not self._output:
+                        self._written.wait(remaining)
+                if not self._output:
+                    break
+                continue
+
+            segment = self._segments[0]
+            now = time.monotonic()
+            ready = self._ready(segment, now)
+
+            if ready > 0:
+                if size is not None:
+                    ready = min(ready, size - len(result))
+                data, consumed = segment[1], segment[2]
+                chunk = data[consumed:consumed + ready]
+
+                if expected:
+                    # The terminator may straddle what was already read
+                    start = max(0, len(result) - len(expected) + 1)
+                    found = (bytes(result[start:]) + chunk).find(expected)
+                    if found >= 0:
+                        chunk = chunk[:start + found + len(expected) - len(result)]
+
+                result += chunk
+                segment[2] += len(chunk)
+                if segment[2] == len(data):
+                    self._segments.popleft()
+                if expected and result.endswith(expected):
+                    break
+                continue
+
+            # Wait for the next byte to be ready, unless it's past the deadline
+            next_ready = segment[0] + (segment[2] + 1) * self.byte_time
+            if deadline is not None and next_ready > deadline:
+                time.sleep(max(0.0, deadline - now))
+                if not self._ready(segment, time.monotonic()) > 0:
+                    break
+                continue
+            time.sleep(max(POLL_INTERVAL, next_ready - now))
+
+        return bytes(result)
+
+    def read(self, size: int = 1) -> bytes:
+        return self.read_until(b'', size)
+
+    def readline(self, size: Optional[int] = None) -> bytes:
+        return self.read_until(b'\n', size)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def write(self, data: bytes) -> int:
+        self.bytes_sent += len(data)
+        self._input += data
+
+        while True:
+            m = re.search(rb'\r\n|\r|\n', self._input)
+            if not m:
+                break
+            command, self._input = self._input[:m.start()], self._input[m.end():]
+            self._output.append(iter((command + b"\r\n",)))
+            self._output.append(self.sim.execute(command))
+            with self._written:
+                self._written.notify_all()
+
+        return len(data)
+
+    @property
+    def in_waiting(self) -> int:
+        now = time.monotonic()
+        return sum(max(0, self._ready(segment, now)) for segment in self._segments)
+
+    def flush(self) -> None:
+        pass
+
+    def reset_input_buffer(self) -> None:
+        self._segments.clear()
+        self._output.clear()
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PtyServer:
+    """
+    Serves a SimulatedSerial on the master side of a pseudo-terminal from a
+    background thread. Open `slave_name` (or use `slave_fd`) as the serial port.
+    """
+
+    def __init__(self, port: SimulatedSerial):
+        self.port = port
+        self.port.timeout = 0
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        self.slave_name = os.ttyname(self.slave_fd)
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop:
+            readable, _, _ = select.select([self.master_fd], [], [], 0.001)
+            if readable:
+                try:
+                    self.port.write(os.read(self.master_fd, 4096))
+                except OSError:
+                    return
+
+            data = self.port.read(65536)
+            if data:
+                os.write(self.master_fd, data)
+
+    def close(self) -> None:
+        self._stop = True
+        self._thread.join()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
@@ -0,0 +1,69 @@
+import os
+
+from bcm_cfedump import CFEParser, PrettyPrinter, PAGE_SIZE
+from cfe_simulator import format_line
+
+
+def parser() -> CFEParser:
+    return CFEParser(None, printer=PrettyPrinter(open(os.devnull, 'w')))
+
+
+def lines_for(data: bytes, base: int) -> list:
+    return [format_line(base + offset, data[offset:offset + 16]).strip() for offset in range(0, len(data), 16)]
+
+
+def test_assemble_whole_page():
+    data = os.urandom(PAGE_SIZE)
+    buf = memoryview(bytearray(PAGE_SIZE))
+
+    stored, last_addr = parser().assemble_lines(buf, lines_for(data, 3 * PAGE_SIZE), 3 * PAGE_SIZE - 16)
+
+    assert (stored, last_addr) == (PAGE_SIZE // 16, 4 * PAGE_SIZE - 16)
+    assert buf == data
+
+
+def test_assemble_missing_line():
+    data = os.urandom(PAGE_SIZE)
+    lines = lines_for(data, PAGE_SIZE)
+    del lines[5]
+    buf = memoryview(bytearray(PAGE_SIZE))
+
+    stored, last_addr = parser().assemble_lines(buf, lines, -1)
+
+    # Lines are placed at their address, the missing one is left as zeroes
+    assert (stored, last_addr) == (PAGE_SIZE // 16 - 1, 2 * PAGE_SIZE - 16)
+    assert buf[:80] == data[:80] and buf[80:96] == bytes(16) and buf[96:] == data[96:]
+
+
+def test_assemble_skips_repeated_lines():
+    data = os.urandom(PAGE_SIZE)
+    lines = lines_for(data, 0)
+    lines.insert(10, lines[3])
+    buf = memoryview(bytearray(PAGE_SIZE))
+
+    stored, _ = parser().assemble_lines(buf, lines, -1)
+
+    assert stored == PAGE_SIZE // 16
+    assert buf == data
+
+
+def test_assemble_drops_malformed_lines():
+    data = os.urandom(PAGE_SIZE)
+    lines = lines_for(data, 0)
+    lines[7] = lines[7][:20] + b' ' + lines[7][21:]
+    buf = memoryview(bytearray(PAGE_SIZE))
+
+    stored, _ = parser().assemble_lines(buf, lines, -1)
+
+    assert stored == PAGE_SIZE // 16 - 1
+    assert buf[:112] == data[:112] and buf[128:] == data[128:]
+
+
+def test_assemble_lines_before_last_address():
+    # Lines the previous page already covered are ignored
+    data = os.urandom(PAGE_SIZE)
+    buf = memoryview(bytearray(PAGE_SIZE))
+
+    stored, last_addr = parser().assemble_lines(buf, lines_for(data, 0), PAGE_SIZE)
+
+    assert (stored, last_addr) == (0, PAGE_SIZE)
@@ -0,0 +1,82 @@
+import asyncio
+import os
+
+import serial
+
+from bcm_cfedump import AsyncCFECommunicator, AsyncSerialTransport, PrettyPrinter, BLOCK_SIZE, PAGE_SIZE
+from cfe_simulator import CFESimulator, SimulatedSerial, PtyServer, OOB_SIZE
+
+PAGES_PER_BLOCK = BLOCK_SIZE // PAGE_SIZE
+
+
+def run(image: bytes, test, oob: bytes = None, **kw):
+    server = PtyServer(SimulatedSerial(CFESimulator(image, oob=oob, drop_rate=kw.pop('drop_rate', 0)), 10000000))
+
+    async def main():
+        with serial.Serial(server.slave_name, timeout=0) as ser:
+            transport = AsyncSerialTransport(ser)
+            try:
+                c = AsyncCFECommunicator(transport, nand_size=len(image), prompt_timeout=1,
+                                         printer=PrettyPrinter(open(os.devnull, 'w')), **kw)
+                await c.wait_for_prompt()
+                return await test(c)
+            finally:
+                transport.close()
+
+    try:
+        return asyncio.run(main())
+    finally:
+        server.close()
+
+
+def test_async_read_pages():
+    image = os.urandom(2 * BLOCK_SIZE)
+
+    async def test(c):
+        return b''.join([bytes(page) async for page in c.read_pages(0, 60, 8)])
+
+    # Pages missing a line are read again
+    assert run(image, test, drop_rate=0.002) == image[60 * PAGE_SIZE:68 * PAGE_SIZE]
+
+
+def test_async_read_pages_bulk():
+    image = os.urandom(2 * BLOCK_SIZE)
+
+    async def test(c):
+        return b''.join([bytes(page) async for page in c.read_pages_bulk(0, 60, 8)])
+
+    assert run(image, test) == image[60 * PAGE_SIZE:68 * PAGE_SIZE]
+
+
+def test_async_scan_bad_blocks():
+    image = bytes(4 * BLOCK_SIZE)
+    oob = bytearray(b'\xff' * (4 * PAGES_PER_BLOCK * OOB_SIZE))
+    oob[(2 * PAGES_PER_BLOCK + 1) * OOB_SIZE] = 0
+
+    async def test(c):
+        return await c.scan_bad_blocks()
+
+    assert run(image, test, bytes(oob)) == [2]
+
+
+def test_async_transport_eof():
+    read_fd, write_fd = os.pipe()
+
+    class Port:
+        def fileno(self):
+            return read_fd
+
+    async def main():
+        transport = AsyncSerialTransport(Port())
+        os.write(write_fd, b"CFE> ")
+        os.close(write_fd)
+        try:
+            assert await transport.read_until(b"CFE>", 1) == b"CFE>"
+            await transport.read_until(b"\n", 1)
+        except IOError:
+            return True
+        finally:
+            transport.close()
+            os.close(read_fd)
+
+    assert asyncio.run(asyncio.wait_for(main(), 5))
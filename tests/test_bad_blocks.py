@@ -0,0 +1,24 @@
+import os
+
+import pytest
+
+from bcm_cfedump import CFECommunicator, PrettyPrinter, BLOCK_SIZE, PAGE_SIZE
+from cfe_simulator import CFESimulator, SimulatedSerial, OOB_SIZE
+
+BLOCKS = 8
+PAGES_PER_BLOCK = BLOCK_SIZE // PAGE_SIZE
+
+
+@pytest.mark.parametrize('garble_rate', (0, 0.01))
+def test_scan_bad_blocks(garble_rate):
+    image = bytes(BLOCKS * BLOCK_SIZE)
+    oob = bytearray(b'\xff' * (BLOCKS * PAGES_PER_BLOCK * OOB_SIZE))
+    # Markers on the first page of block 2 and the second page of block 5
+    oob[2 * PAGES_PER_BLOCK * OOB_SIZE] = 0
+    oob[(5 * PAGES_PER_BLOCK + 1) * OOB_SIZE] = 0
+    sim = CFESimulator(image, oob=bytes(oob), garble_rate=garble_rate)
+    c = CFECommunicator(SimulatedSerial(sim, 100000000, 0.05), nand_size=len(image),
+                        printer=PrettyPrinter(open(os.devnull, 'w')))
+    c.wait_for_prompt()
+
+    assert c.scan_bad_blocks() == [2, 5]
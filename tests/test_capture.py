@@ -0,0 +1,67 @@
+import io
+import os
+import random
+
+import pytest
+
+from bcm_cfedump import CFEParser, PrettyPrinter, PAGE_SIZE
+from cfe_simulator import CFESimulator
+
+PAGES = 8
+
+
+def capture(sim: CFESimulator, commands: list) -> bytes:
+    """
+    Console output of page by page reads, as a capture would hold it.
+    """
+    output = b"CFE> "
+    for command in commands:
+        output += command.encode() + b"\r\n"
+        output += b''.join(chunk for chunk in sim.execute(command.encode()) if isinstance(chunk, bytes))
+    return output
+
+
+def parser(data: bytes) -> CFEParser:
+    return CFEParser(io.BytesIO(data), nand_size=PAGES * PAGE_SIZE, printer=PrettyPrinter(open(os.devnull, 'w')))
+
+
+@pytest.mark.parametrize('window', (1, 4))
+def test_truncated_capture(window):
+    image = random.Random(0).randbytes(PAGES * PAGE_SIZE)
+    data = capture(CFESimulator(image), ["dn 0 {} 1".format(i) for i in range(PAGES)])
+    c = parser(data[:len(data) // 2])
+    c.window = window
+
+    pages = []
+    with pytest.raises(IOError):
+        for page in c.read_pages(0, 0, PAGES):
+            pages.append(bytes(page))
+    assert pages == [image[i * PAGE_SIZE:(i + 1) * PAGE_SIZE] for i in range(len(pages))]
+
+
+def damaged_capture(image: bytes, retried: bool) -> bytes:
+    # Page 3 is missing a line, and was read again only if `retried`
+    sim = CFESimulator(image)
+    commands = ["dn 0 {} 1".format(i) for i in range(PAGES)]
+    if retried:
+        commands.insert(4, commands[3])
+    data = capture(sim, commands)
+    start = data.index(b"block: 0, page: 3")
+    line = data.index(b"\r\n", start) + 2
+    return data[:line] + data[data.index(b"\r\n", line) + 2:]
+
+
+def test_capture_retried_page():
+    image = random.Random(0).randbytes(PAGES * PAGE_SIZE)
+    pages = [bytes(page) for page in parser(damaged_capture(image, True)).read_pages(0, 0, PAGES)]
+    assert b''.join(pages) == image
+
+
+def test_capture_page_not_retried():
+    # The next page's section isn't taken for the failed one
+    image = random.Random(0).randbytes(PAGES * PAGE_SIZE)
+    pages = []
+    with pytest.raises(IOError):
+        for page in parser(damaged_capture(image, False)).read_pages(0, 0, PAGES):
+            pages.append(bytes(page))
+    assert pages == [image[i * PAGE_SIZE:(i + 1) * PAGE_SIZE] for i in range(3)]
@@ -0,0 +1,60 @@
+import io
+import os
+
+import pytest
+
+from bcm_cfedump import parse_serial_lines, CFEParser, PrettyPrinter, PAGE_SIZE
+from cfe_simulator import format_line
+
+
+def lines_for(data: bytes, base: int = 0) -> list:
+    return [format_line(base + offset, data[offset:offset + 16]).strip() for offset in range(0, len(data), 16)]
+
+
+def test_parse_serial_lines():
+    data = os.urandom(PAGE_SIZE)
+    addrs, decoded = parse_serial_lines(lines_for(data, 0x800))
+
+    assert addrs == tuple(range(0x800, 0x800 + PAGE_SIZE, 16))
+    assert decoded == data
+
+
+@pytest.mark.parametrize('line, error', [
+    (b"00000000 00112233 44556677 8899aabb ccddeeff", "no colon"),
+    (b"00000000: 00112233 44556677 8899aabb ccddee", "truncated"),
+    (b"00000000: 00112233 44556677 8899aabb ccddeefg", "not hex"),
+    (b"00000000: 001122330445566778899aabb ccddeeff", "space turned into a digit"),
+    (b"00000000: 00112233 4455 677 8899aabb ccddeeff", "digit turned into a space"),
+])
+def test_parse_serial_lines_rejects(line, error):
+    lines = lines_for(bytes(32))
+    with pytest.raises(ValueError):
+        parse_serial_lines(lines[:1] + [line] + lines[1:])
+
+
+def test_parse_serial_lines_garbling_cancels_out():
+    # One line gains a digit (a space garbled into one), another loses one (a digit garbled into a space):
+    # the total number of digits is right, but each line is malformed
+    lines = lines_for(bytes(range(64)))
+    lines[1] = lines[1][:18] + b'a' + lines[1][19:]
+    lines[2] = lines[2][:20] + b' ' + lines[2][21:]
+
+    with pytest.raises(ValueError):
+        parse_serial_lines(lines)
+
+
+def test_decode_lines_drops_malformed_lines(capsys):
+    data = bytes(range(64))
+    lines = lines_for(data)
+    lines[1] = lines[1][:18] + b'a' + lines[1][19:]
+    lines[2] = lines[2][:20] + b' ' + lines[2][21:]
+
+    out = io.StringIO()
+    c = CFEParser(None, printer=PrettyPrinter(out))
+    addrs, decoded = c.decode_lines(lines)
+
+    assert addrs == (0x00, 0x30)
+    assert decoded == data[:16] + data[48:]
+    # Reported through the printer only, which may be drawing a progress table
+    assert out.getvalue().count("Error caused by line") == 2
+    assert capsys.readouterr() == ('', '')
@@ -0,0 +1,33 @@
+import json
+import os
+
+from bcm_cfedump import CFECommunicator, DumpMetrics, PrettyPrinter, PAGE_SIZE
+from cfe_simulator import CFESimulator, SimulatedSerial
+
+PAGES = 8
+
+
+def test_windowed_metrics(tmp_path):
+    image = os.urandom(PAGES * PAGE_SIZE)
+    c = CFECommunicator(SimulatedSerial(CFESimulator(image), 10000000, 0.05), nand_size=len(image), window=4,
+                        printer=PrettyPrinter(open(os.devnull, 'w')))
+    c.wait_for_prompt()
+
+    metrics = DumpMetrics(str(tmp_path / "metrics.jsonl"), 'jsonl', 'sim')
+    c.enable_metrics(metrics)
+    for i, _ in enumerate(c.read_pages(0, 0, PAGES)):
+        metrics.page(i, PAGES)
+    metrics.close()
+
+    with open(str(tmp_path / "metrics.jsonl")) as f:
+        records = [json.loads(line) for line in f]
+    assert [record['page'] for record in records] == list(range(PAGES))
+    # Pages share their command's events, prompt included
+    for window in (records[:4], records[4:]):
+        for event in ('sent', 'first_byte', 'prompt'):
+            assert len({record[event] for record in window}) == 1
+        for record in window:
+            assert record['sent'] <= record['first_byte'] <= record['data_end'] <= record['prompt']
+    assert records[3]['prompt'] <= records[4]['sent']
+    assert metrics.phases['latency'][1] == metrics.phases['prompt_wait'][1] == 2
+    assert metrics.phases['transfer'][1] == PAGES
@@ -0,0 +1,86 @@
+import os
+import random
+
+import pytest
+
+from bcm_cfedump import CFECommunicator, NandImage, PrettyPrinter, BLOCK_SIZE, PAGE_SIZE
+from cfe_simulator import CFESimulator, SimulatedSerial
+
+
+class LoggingSerial(SimulatedSerial):
+    """
+    Keeps the `dn` commands written, as (first page, count).
+    """
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.commands = []
+
+    def write(self, data: bytes) -> int:
+        for command in data.split(b"\r\n"):
+            if command.startswith(b"dn "):
+                block, page, count = map(int, command.split()[1:])
+                self.commands.append((block * (BLOCK_SIZE // PAGE_SIZE) + page, count))
+        return super().write(data)
+
+
+@pytest.fixture
+def nand():
+    image = random.Random(0).randbytes(2 * BLOCK_SIZE)
+    port = LoggingSerial(CFESimulator(image), 100000000, 0.05)
+    c = CFECommunicator(port, nand_size=len(image), printer=PrettyPrinter(open(os.devnull, 'w')))
+    c.wait_for_prompt()
+    return image, port, NandImage(c, cache_size=4 * PAGE_SIZE)
+
+
+def test_seek_read(nand):
+    image, port, f = nand
+    f.seek(PAGE_SIZE - 10)
+    # Pages 0 and 1, in a single command
+    assert f.read(20) == image[PAGE_SIZE - 10:PAGE_SIZE + 10]
+    assert f.tell() == PAGE_SIZE + 10
+    assert port.commands == [(0, 2)]
+
+    assert f.seek(-5, os.SEEK_END) == len(image) - 5
+    assert f.read(100) == image[-5:]
+    assert f.read(100) == b''
+    assert f.seek(-PAGE_SIZE, os.SEEK_CUR) == len(image) - PAGE_SIZE
+    with pytest.raises(ValueError):
+        f.seek(-1)
+
+
+def test_slicing(nand):
+    image, port, f = nand
+    assert f[100:200] == image[100:200]
+    assert f[5] == image[5] and f[-1] == image[-1]
+    assert f[-300:-100] == image[-300:-100]
+    assert f[10:5000:7] == image[10:5000:7]
+    assert f[5000:10:-3] == image[5000:10:-3]
+    assert f[300:100:-1] == image[300:100:-1]
+    assert f[200:100] == b''
+    with pytest.raises(IndexError):
+        f[len(image)]
+
+
+def test_cache(nand):
+    image, port, f = nand
+    # Pages 0-3 fill the cache, 4 evicts page 0
+    assert f[:5 * PAGE_SIZE] == image[:5 * PAGE_SIZE]
+    assert port.commands == [(0, 4), (4, 1)]
+
+    assert f[PAGE_SIZE] == image[PAGE_SIZE]
+    assert len(port.commands) == 2
+    assert f[0] == image[0]
+    assert port.commands[2:] == [(0, 1)]
+    # Page 2 was the least recently used
+    assert f[2 * PAGE_SIZE] == image[2 * PAGE_SIZE]
+    assert port.commands[3:] == [(2, 1)]
+
+
+def test_coalescing(nand):
+    image, port, f = nand
+    assert f[PAGE_SIZE] == image[PAGE_SIZE]
+    # Misses on either side of a cached page are separate runs
+    assert f[:3 * PAGE_SIZE] == image[:3 * PAGE_SIZE]
+    assert port.commands == [(1, 1), (0, 1), (2, 1)]
+    assert f.stats() == "3 pages read in 3 commands, 1 cache hits"
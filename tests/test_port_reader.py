@@ -0,0 +1,52 @@
+import os
+
+from bcm_cfedump import CFECommunicator, PortReader, PrettyPrinter, PAGE_SIZE
+from cfe_simulator import CFESimulator, SimulatedSerial
+
+
+class GuardedSerial(SimulatedSerial):
+    """
+    Records any reconfiguration made while a read is in progress.
+    """
+
+    def __init__(self, *a, **kw):
+        self.reading = False
+        self.overlaps = []
+        super().__init__(*a, **kw)
+
+    def read_until(self, *a, **kw) -> bytes:
+        self.reading = True
+        try:
+            return super().read_until(*a, **kw)
+        finally:
+            self.reading = False
+
+    @property
+    def baudrate(self) -> int:
+        return self._baudrate
+
+    @baudrate.setter
+    def baudrate(self, value: int) -> None:
+        if self.reading:
+            self.overlaps.append('baudrate')
+        self._baudrate = value
+
+    def reset_input_buffer(self) -> None:
+        if self.reading:
+            self.overlaps.append('reset_input_buffer')
+        super().reset_input_buffer()
+
+
+def test_reconfigure_while_reading():
+    image = os.urandom(16 * PAGE_SIZE)
+    port = GuardedSerial(CFESimulator(image), 3000000, 0.05)
+    ser = PortReader(port)
+    c = CFECommunicator(ser, nand_size=len(image), printer=PrettyPrinter(open(os.devnull, 'w')))
+    c.wait_for_prompt()
+
+    assert c.escalate_baudrate([6000000], "setbaud {baudrate}") == 6000000
+    assert port.baudrate == 6000000
+    assert bytes(c.read_page(0, 3)) == image[3 * PAGE_SIZE:4 * PAGE_SIZE]
+    ser.close()
+
+    assert port.overlaps == []
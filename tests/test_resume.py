@@ -0,0 +1,59 @@
+import os
+import random
+import sys
+
+import bcm_cfedump
+from bcm_cfedump import BLOCK_SIZE, PAGE_SIZE
+from cfe_simulator import CFESimulator, SimulatedSerial
+
+PAGES = BLOCK_SIZE // PAGE_SIZE
+
+
+class CountingSerial(SimulatedSerial):
+    """
+    Counts the pages requested with `dn`.
+    """
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.pages = 0
+
+    def write(self, data: bytes) -> int:
+        for command in data.split(b"\r\n"):
+            if command.startswith(b"dn "):
+                self.pages += int(command.split()[3])
+        return super().write(data)
+
+
+def dump(monkeypatch, image: bytes, output: str) -> int:
+    """
+    Dump the first block with -R, returning the number of pages read.
+    """
+    port = CountingSerial(CFESimulator(image), 100000000)
+    monkeypatch.setattr(bcm_cfedump.serial, 'Serial', lambda device, baudrate, timeout: port)
+    monkeypatch.setattr(sys, 'argv', ['bcm_cfedump', '-D', 'sim', '-t', '0.05', '-N', str(len(image)), '-R',
+                                      '-O', output, 'block', '0', '1'])
+    with open(os.devnull, 'w') as devnull:
+        monkeypatch.setattr(sys, 'stdout', devnull)
+        monkeypatch.setattr(sys, 'stderr', devnull)
+        bcm_cfedump.main()
+    return port.pages
+
+
+def test_resume(monkeypatch, tmp_path):
+    image = random.Random(0).randbytes(2 * BLOCK_SIZE)
+    output = str(tmp_path / "nand.img")
+    assert dump(monkeypatch, image, output) == PAGES
+
+    # Interrupted after 40 pages, one of which was damaged since
+    with open(output, 'r+b') as f:
+        f.truncate(40 * PAGE_SIZE)
+        f.seek(5 * PAGE_SIZE + 100)
+        f.write(b'\0')
+
+    assert dump(monkeypatch, image, output) == 1 + PAGES - 40
+    with open(output, 'rb') as f:
+        assert f.read() == image[:BLOCK_SIZE]
+
+    # Nothing left to read
+    assert dump(monkeypatch, image, output) == 0
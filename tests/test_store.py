@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from bcm_cfedump import PageStore, STORE_HANDLES
+
+
+def store(path, oob_size: int = 0) -> PageStore:
+    return PageStore(str(path), 'board', 64, oob_size, 4)
+
+
+def test_store_round_trip(tmp_path):
+    s = store(tmp_path)
+    pages = {i: os.urandom(64) for i in range(0, 4 * (STORE_HANDLES + 4), 3)}
+    for i, data in pages.items():
+        s.put(i, data)
+    assert len(s._files) == STORE_HANDLES
+
+    # Every page is served, through the open files and those opened again
+    for i in range(4 * (STORE_HANDLES + 4)):
+        assert s.get(i) == pages.get(i)
+        assert s.has(i) == (i in pages)
+    s.close()
+
+    s = store(tmp_path)
+    assert s.get(3) == pages[3]
+    s.close()
+
+
+def test_store_layouts_kept_apart(tmp_path):
+    s = store(tmp_path)
+    s.put(1, b'\1' * 64)
+    s.close()
+
+    s = store(tmp_path, 16)
+    assert s.get(1) is None
+    s.put(1, b'\2' * 80)
+    s.close()
+
+    s = store(tmp_path)
+    assert s.get(1) == b'\1' * 64
+    s.close()
+
+
+def test_store_rejects_bad_header(tmp_path):
+    s = store(tmp_path)
+    s.put(1, b'\1' * 64)
+    s.close()
+
+    path = s._block_path(0)
+    with open(path, 'r+b') as f:
+        f.write(b'XXXX')
+
+    s = store(tmp_path)
+    with pytest.raises(ValueError):
+        s.get(1)
+    s.close()
+    assert os.path.getsize(path) > 4
@@ -0,0 +1,78 @@
+import os
+import random
+
+import pytest
+
+from bcm_cfedump import CFECommunicator, PrettyPrinter, PAGE_SIZE
+from cfe_simulator import CFESimulator, SimulatedSerial, OOB_SIZE
+
+PAGES = 16
+
+
+class LossySimulator(CFESimulator):
+    """
+    Loses or garbles parts of the output of given pages, the first time only
+    (re-reads come out right).
+    """
+
+    def __init__(self, image: bytes, faults: dict, **kw):
+        super().__init__(image, **kw)
+        self.faults = dict(faults)
+
+    def dump_page(self, page: int):
+        fault = self.faults.pop(page, None)
+        for chunk in super().dump_page(page):
+            if fault == 'spare' and b'spare area' in chunk:
+                continue
+            if fault == 'header' and b'block:' in chunk:
+                continue
+            if fault == 'number' and b'block:' in chunk:
+                chunk = chunk.replace(b'page: ', b'page: 1')
+            if fault == 'garbled header' and b'block:' in chunk:
+                chunk = chunk.replace(b'block:', b'blo#k:')
+            if fault == 'line' and chunk.startswith(b'0'):
+                chunk = chunk[chunk.index(b'\n') + 1:]
+            yield chunk
+
+
+def read(faults: dict, oob_size: int = 0, window: int = 8) -> bytes:
+    image = random.Random(0).randbytes(PAGES * PAGE_SIZE)
+    sim = LossySimulator(image, faults, oob_size=OOB_SIZE)
+    c = CFECommunicator(SimulatedSerial(sim, 100000000, 0.05), nand_size=len(image), window=window,
+                        printer=PrettyPrinter(open(os.devnull, 'w')), oob_size=oob_size)
+    c.wait_for_prompt()
+
+    pages = [bytes(page[:PAGE_SIZE]) for page in c.read_pages(0, 0, PAGES)]
+    assert len(pages) == PAGES
+    return image, b''.join(pages)
+
+
+@pytest.mark.parametrize('oob_size', (0, OOB_SIZE))
+@pytest.mark.parametrize('fault', ('spare', 'header', 'number', 'garbled header', 'line'))
+def test_windowed_read_recovers(fault, oob_size):
+    image, data = read({4: fault, 11: fault}, oob_size)
+    assert data == image
+
+
+def test_windowed_read_last_page_lost():
+    image, data = read({7: 'spare', 15: 'header'})
+    assert data == image
+
+
+def test_windowed_read_clean():
+    image, data = read({}, window=PAGES)
+    assert data == image
+
+
+@pytest.mark.parametrize('window', (1, 8))
+def test_spare_area_not_whole_lines(window):
+    # A 40 byte spare area is dumped as three whole lines, the last one partly padding
+    image = random.Random(0).randbytes(PAGES * PAGE_SIZE)
+    oob = random.Random(1).randbytes(PAGES * 48)
+    sim = CFESimulator(image, oob=oob, oob_size=48)
+    c = CFECommunicator(SimulatedSerial(sim, 100000000, 0.05), nand_size=len(image), window=window,
+                        printer=PrettyPrinter(open(os.devnull, 'w')), oob_size=40)
+    c.wait_for_prompt()
+
+    pages = [bytes(page) for page in c.read_pages(0, 0, PAGES)]
+    assert pages == [image[i * PAGE_SIZE:(i + 1) * PAGE_SIZE] + oob[i * 48:i * 48 + 40] for i in range(PAGES)]